@@ -0,0 +1,131 @@
+'''A record (a SQLite file) of how far each mp-id of a submission campaign has gotten, used by
+workflow_writers.add_workflows_mpid when it is given a campaign name. Each mp-id goes through the states:
+    fetched - the structure was downloaded from the MP (and is saved here, so it is not downloaded again)
+    built - the workflow was created
+    submitted - the workflow was added to the launchpad (its fw_ids are saved here)
+Running the same campaign again skips everything that was already submitted, so a campaign that was stopped partway
+(by an error, the workflow cap, or a lost connection) can simply be started again.'''
+
+import json
+import sqlite3
+import time
+
+from pymatgen.core import Structure
+
+# the journal file is kept next to api_key.txt and db.json
+JOURNAL_FILE = "campaign_journal.sqlite"
+
+FETCHED = "fetched"
+BUILT = "built"
+SUBMITTED = "submitted"
+
+
+def _connect(journal_file):
+    '''Opens the journal file, creating the table the first time'''
+
+    connection = sqlite3.connect(journal_file or JOURNAL_FILE, timeout=30)
+    connection.execute('''CREATE TABLE IF NOT EXISTS items
+                          (campaign TEXT, workflow_name TEXT, mp_id TEXT, state TEXT, formula TEXT, structure TEXT,
+                           task_range TEXT, fw_ids TEXT, updated REAL, PRIMARY KEY (campaign, workflow_name, mp_id))''')
+    return connection
+
+def _write(journal_file, statement, rows):
+    connection = _connect(journal_file)
+    try:
+        with connection:
+            connection.executemany(statement, rows)
+    finally:
+        connection.close()
+
+def record_fetched(campaign, workflow_name, structures, formulas, journal_file=None):
+    '''Records that the structures for some mp-ids were downloaded, saving the structures and formulas
+
+    Parameters:
+        campaign (str): the name of the campaign. Ex: 'dielectric 09/2021'
+        workflow_name (str): the type of workflow. Ex: 'dielectric'
+        structures (dict): the pymatgen structure for each mp-id
+        formulas (dict): the pretty formula for each mp-id
+        journal_file (str): the journal file to use (defaults to JOURNAL_FILE)
+    Returns:
+        None
+
+    '''
+
+    now = time.time()
+    _write(journal_file, '''INSERT OR REPLACE INTO items (campaign, workflow_name, mp_id, state, formula, structure, updated)
+                            VALUES (?, ?, ?, ?, ?, ?, ?)''',
+           [(campaign, workflow_name, mp_id, FETCHED, formulas[mp_id], structure.to_json(), now)
+            for mp_id, structure in structures.items()])
+
+def record_built(campaign, workflow_name, mp_ids, journal_file=None):
+    '''Records that the workflows for some (already fetched) mp-ids were created'''
+
+    now = time.time()
+    _write(journal_file, "UPDATE items SET state = ?, updated = ? WHERE campaign = ? AND workflow_name = ? AND mp_id = ?",
+           [(BUILT, now, campaign, workflow_name, mp_id) for mp_id in mp_ids])
+
+def record_submitted(campaign, workflow_name, submitted, journal_file=None):
+    '''Records that some workflows were added to the launchpad
+
+    Parameters:
+        campaign (str): the name of the campaign
+        workflow_name (str): the type of workflow
+        submitted (list): (mp_id, formula, task_range, fw_ids) for each workflow added
+        journal_file (str): the journal file to use (defaults to JOURNAL_FILE)
+    Returns:
+        None
+
+    '''
+
+    now = time.time()
+    # the structure is no longer needed once the workflow is in the launchpad
+    _write(journal_file, '''INSERT OR REPLACE INTO items (campaign, workflow_name, mp_id, state, formula, task_range, fw_ids, updated)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+           [(campaign, workflow_name, mp_id, SUBMITTED, formula, task_range, json.dumps(list(fw_ids)), now)
+            for mp_id, formula, task_range, fw_ids in submitted])
+
+def load_campaign(campaign, workflow_name, journal_file=None):
+    '''Reads back everything recorded for a campaign
+
+    Parameters:
+        campaign (str): the name of the campaign
+        workflow_name (str): the type of workflow
+        journal_file (str): the journal file to use (defaults to JOURNAL_FILE)
+    Returns:
+        submitted (dict): for each submitted mp-id, its (formula, task_range, fw_ids), in the order they were submitted
+        structures (dict): the saved structure of each mp-id that was fetched but not submitted yet
+        formulas (dict): the formula of each mp-id that was fetched but not submitted yet
+
+    '''
+
+    connection = _connect(journal_file)
+    try:
+        rows = connection.execute('''SELECT mp_id, state, formula, structure, task_range, fw_ids FROM items
+                                     WHERE campaign = ? AND workflow_name = ? ORDER BY updated, rowid''',
+                                  (campaign, workflow_name)).fetchall()
+    finally:
+        connection.close()
+
+    submitted = {}
+    structures = {}
+    formulas = {}
+    for mp_id, state, formula, structure, task_range, fw_ids in rows:
+        if state == SUBMITTED:
+            submitted[mp_id] = (formula, task_range, json.loads(fw_ids))
+        else:
+            structures[mp_id] = Structure.from_dict(json.loads(structure))
+            formulas[mp_id] = formula
+
+    return submitted, structures, formulas
+
+def campaign_status(campaign, journal_file=None):
+    '''Returns the number of mp-ids of a campaign in each state, e.g. {'submitted': 480, 'fetched': 20}'''
+
+    connection = _connect(journal_file)
+    try:
+        rows = connection.execute("SELECT state, COUNT(*) FROM items WHERE campaign = ? GROUP BY state",
+                                  (campaign,)).fetchall()
+    finally:
+        connection.close()
+
+    return dict(rows)
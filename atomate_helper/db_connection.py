@@ -0,0 +1,123 @@
+'''Keeps one open connection per db.json (or launchpad) file for the whole python process, so the functions in
+query_db, edit_db and workflow_writers don't have to re-read the file, open a new MongoClient and authenticate
+every time they are called.'''
+
+from collections import OrderedDict
+import os
+import threading
+
+from atomate.vasp.database import VaspCalcDb
+from fireworks import LaunchPad
+
+# how many different databases are kept open at once. When another one is opened, the one that was used the
+# longest time ago is closed.
+MAX_OPEN_CONNECTIONS = 4
+
+_connections = OrderedDict()
+_lock = threading.RLock()
+_owner_pid = os.getpid()
+
+
+def _forget_connections():
+    '''MongoClients are not fork safe, so a child process (e.g. in a worker pool) throws away the connections it
+    inherited from its parent and opens its own the first time it needs one. The parent's sockets are left alone.'''
+
+    global _owner_pid
+
+    _connections.clear()
+    _owner_pid = os.getpid()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_connections)
+
+
+def _close_handle(handle):
+    '''Closes the MongoClient behind a VaspCalcDb or LaunchPad'''
+
+    try:
+        handle.connection.close()
+    except Exception:
+        pass
+
+def _get_cached(key, opener):
+    '''Returns the cached handle for key, opening it with opener() if needed'''
+
+    with _lock:
+        # catches forks done without os.fork (e.g. multiprocessing on older pythons)
+        if os.getpid() != _owner_pid:
+            _forget_connections()
+
+        if key in _connections:
+            _connections.move_to_end(key)
+            return _connections[key]
+
+        handle = opener()
+        _connections[key] = handle
+
+        while len(_connections) > MAX_OPEN_CONNECTIONS:
+            _, oldest = _connections.popitem(last=False)
+            _close_handle(oldest)
+
+        return handle
+
+def get_atomate_db(path_to_my_db_json):
+    '''Returns the (shared) VaspCalcDb for a db.json file, connecting the first time it is asked for.
+
+    Parameters:
+        path_to_my_db_json (str): the path to your db.sjon file, eg. '/home/calebh27/atomate/config/db.json'
+    Returns:
+        atomate_db (VaspCalcDb): the connection to the database
+
+    '''
+
+    key = ("db", os.path.abspath(path_to_my_db_json))
+    return _get_cached(key, lambda: VaspCalcDb.from_db_file(path_to_my_db_json))
+
+def get_materials_collection(path_to_my_db_json):
+    '''Returns the materials collection (created by the builders) of the database in the db.json file
+
+    Parameters:
+        path_to_my_db_json (str): the path to your db.sjon file, eg. '/home/calebh27/atomate/config/db.json'
+    Returns:
+        materials_collection (object): the pymongo collection
+
+    '''
+
+    return get_atomate_db(path_to_my_db_json).db['materials']
+
+def get_launchpad(launchpad_file=None):
+    '''Returns the (shared) LaunchPad for a my_launchpad.yaml file. If no file is given, the launchpad FireWorks
+    finds on its own is used (the same one lpad uses on the command line).
+
+    Parameters:
+        launchpad_file (str): the path to your my_launchpad.yaml file, eg. '/home/calebh27/atomate/config/my_launchpad.yaml'
+    Returns:
+        launchpad (LaunchPad): the launchpad
+
+    '''
+
+    if launchpad_file is None:
+        return _get_cached(("launchpad", None), LaunchPad.auto_load)
+
+    key = ("launchpad", os.path.abspath(launchpad_file))
+    return _get_cached(key, lambda: LaunchPad.from_file(launchpad_file))
+
+def close(path=None):
+    '''Closes the cached connection for a db.json/launchpad file, or every cached connection if no path is given.
+    The next function that needs the database will simply reconnect.
+
+    Parameters:
+        path (str): the db.json or my_launchpad.yaml file whose connection should be closed
+    Returns:
+        None
+
+    '''
+
+    with _lock:
+        if path is None:
+            keys = list(_connections)
+        else:
+            keys = [key for key in _connections if key[1] == os.path.abspath(path)]
+
+        for key in keys:
+            _close_handle(_connections.pop(key))
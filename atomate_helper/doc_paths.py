@@ -0,0 +1,41 @@
+'''Reading dot-paths (e.g. 'dielectric.epsilon_static') out of mongodb docs and building projections for them, shared
+by query_db, materials_snapshot and run_builders.'''
+
+# returned by get_path when a field does not exist (a field can exist and be None)
+NOT_FOUND = object()
+
+def get_path(doc, keys):
+    '''Follows a key path (tuple of keys) into a doc, returning NOT_FOUND if any part of it is not there'''
+
+    value = doc
+    for key in keys:
+        if isinstance(value, dict) and key in value:
+            value = value[key]
+        else:
+            return NOT_FOUND
+    return value
+
+def get_field(doc, field):
+    '''Gets a dot-path (e.g. 'last_updated' or 'dielectric.epsilon_static') from a doc, or None if it is not there'''
+
+    value = get_path(doc, field.split("."))
+    return None if value is NOT_FOUND else value
+
+def collapse_projection(paths, projection=None):
+    '''Adds dot-paths to a mongodb projection.
+
+    Parameters:
+        paths (str list): the fields to include. Ex. ['dielectric', 'dielectric.epsilon_static', 'formula_pretty']
+        projection (dict): what the projection starts with, e.g. {'_id': 0}
+    Returns:
+        projection (dict): the projection to pass to find(). Ex. {'_id': 0, 'dielectric': 1, 'formula_pretty': 1}
+
+    '''
+
+    projection = dict(projection or {})
+    # mongodb will not project both a field and something inside of it, so only the outer field is kept
+    for path in sorted(set(paths)):
+        if not any(path.startswith(kept + ".") for kept in projection):
+            projection[path] = 1
+
+    return projection
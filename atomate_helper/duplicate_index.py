@@ -0,0 +1,94 @@
+'''Keeps track of which (mp-id, workflow type, INCAR changes) combinations are already in a launchpad, so that
+workflow_writers can skip submitting the same calculation twice.
+
+The workflows added by workflow_writers have their mp-id, workflow type and INCAR changes saved in the workflow
+metadata. The first check reads those fields (and nothing else) from every workflow in the launchpad, once; after that,
+only workflows updated since the last check are read. Workflows added some other way (without that metadata) are not
+seen. DEFUSED and ARCHIVED workflows don't count as duplicates, so they can be submitted again.'''
+
+import json
+
+# the workflow states that don't count as already being in the launchpad
+INACTIVE_STATES = ("DEFUSED", "ARCHIVED")
+
+# for each launchpad: {fingerprint: set of workflow _ids}, and the newest updated_on that has been read
+_fingerprints = {}
+_last_sync = {}
+
+
+def incar_fingerprint(incar_update):
+    '''Turns the INCAR changes requested for a workflow into a string that is the same for the same changes'''
+
+    return json.dumps(incar_update or {}, sort_keys=True)
+
+def workflow_fingerprint(mp_id, workflow_name, incar_update=None):
+    '''The fingerprint that identifies a workflow: its mp-id, type and INCAR changes'''
+
+    return (mp_id, workflow_name, incar_fingerprint(incar_update))
+
+def workflow_metadata(mp_id, workflow_name, incar_update=None):
+    '''The metadata saved in each workflow added by workflow_writers, which is what the index is built from'''
+
+    return {"mp_id": mp_id, "workflow_type": workflow_name, "incar_fingerprint": incar_fingerprint(incar_update)}
+
+def _launchpad_key(launchpad):
+    return (getattr(launchpad, "host", None), getattr(launchpad, "port", None), getattr(launchpad, "name", None))
+
+def refresh_workflow_index(launchpad, full=False):
+    '''Brings the local index up to date with the launchpad, reading only the workflows updated since the last refresh
+    (or all of them the first time, or if full is True).
+
+    Parameters:
+        launchpad (object): the launchpad
+        full (bool): whether to throw away the index and read every workflow again
+    Returns:
+        fingerprints (dict): the _ids of the active workflows for each fingerprint
+
+    '''
+
+    key = _launchpad_key(launchpad)
+    if full or key not in _fingerprints:
+        _fingerprints[key] = {}
+        _last_sync[key] = None
+
+    fingerprints = _fingerprints[key]
+    query = {"metadata.mp_id": {"$exists": True}}
+    if _last_sync[key] is not None:
+        # $gte, so workflows updated in the same instant as the last one read are not missed
+        query["updated_on"] = {"$gte": _last_sync[key]}
+
+    projection = {"metadata.mp_id": 1, "metadata.workflow_type": 1, "metadata.incar_fingerprint": 1,
+                  "state": 1, "updated_on": 1}
+
+    for workflow in launchpad.workflows.find(query, projection):
+        metadata = workflow["metadata"]
+        fingerprint = (metadata["mp_id"], metadata.get("workflow_type"), metadata.get("incar_fingerprint", "{}"))
+        workflow_ids = fingerprints.setdefault(fingerprint, set())
+
+        if workflow.get("state") in INACTIVE_STATES:
+            workflow_ids.discard(workflow["_id"])
+        else:
+            workflow_ids.add(workflow["_id"])
+
+        updated_on = workflow.get("updated_on")
+        if updated_on is not None and (_last_sync[key] is None or updated_on > _last_sync[key]):
+            _last_sync[key] = updated_on
+
+    return fingerprints
+
+def find_duplicates(launchpad, mp_ids, workflow_name, incar_update=None):
+    '''Returns the mp-ids that already have an active workflow of this type (with the same INCAR changes) in the launchpad
+
+    Parameters:
+        launchpad (object): the launchpad
+        mp_ids (str list): the mp-ids that are about to be submitted. Ex: ['mp-594', 'mp-1547']
+        workflow_name (str): the type of workflow. Ex: 'dielectric'
+        incar_update (dict): the INCAR changes that will be made to the workflows (None if there are none)
+    Returns:
+        duplicate_ids (str list): the mp-ids that are already in the launchpad
+
+    '''
+
+    fingerprints = refresh_workflow_index(launchpad)
+
+    return [mp_id for mp_id in mp_ids if fingerprints.get(workflow_fingerprint(mp_id, workflow_name, incar_update))]
@@ -1,5 +1,61 @@
 from helper_core import get_material_ids
-from atomate.vasp.database import VaspCalcDb
+from db_connection import get_materials_collection
+from pymongo import UpdateMany
+
+def bulk_update_keywords(materials_collection, material_ids, update, chunk_size=1000, changes_if=None):
+    ''' Applies a keyword update to every doc in the materials collection matching the given mp-ids. Instead of a
+    find_one and update_one per id, each chunk of ids is looked up with a single $in query, and all the updates
+    are sent to the database together in one bulk_write.
+
+    Parameters:
+        materials_collection (object): the materials collection, e.g. get_materials_collection(path_to_my_db_json)
+        material_ids (str list): the mp-ids of the substances you want to update, e.g. ["mp-123", "mp-234"]
+        update (dict): the mongodb update to apply, e.g. { "$push": { "keywords": {"$each": ["09/2021"]} } }
+        chunk_size (int): the number of mp-ids sent to the database in each $in query and update
+        changes_if (dict): a condition that only the docs the update would change meet, e.g.
+                           {'keywords': {'$in': keywords_to_remove}}, so the others are left alone (None updates all)
+
+    Returns:
+        missing_ids (str list): mp-ids that were not found in the database
+        matched_count (int): the number of docs matched by the updates (only the ones meeting changes_if)
+        modified_count (int): the number of docs that were actually changed by the updates
+
+    '''
+
+    # the update time is saved so the local snapshot (see materials_snapshot.py) knows to copy the doc again. Only the
+    # docs that will really change are updated, so the ones that don't keep their last_updated
+    update = dict(update, **{"$currentDate": {"last_updated": True}})
+
+    missing_ids = []
+    operations = []
+
+    for start in range(0, len(material_ids), chunk_size):
+        chunk = material_ids[start:start + chunk_size]
+
+        #find which of the ids are in the database, only pulling back the mpids field
+        found_ids = set()
+        for material in materials_collection.find({'mpids': {'$in': chunk}}, {'mpids': 1, '_id': 0}):
+            found_ids.update(material['mpids'])
+
+        chunk_found = []
+        for mp_id in chunk:
+            if mp_id in found_ids:
+                chunk_found.append(mp_id)
+            else:
+                missing_ids.append(mp_id)
+
+        if chunk_found:
+            update_filter = {'mpids': {'$in': chunk_found}}
+            if changes_if:
+                update_filter.update(changes_if)
+            operations.append(UpdateMany(update_filter, update))
+
+    if not operations:
+        return missing_ids, 0, 0
+
+    result = materials_collection.bulk_write(operations, ordered=False)
+
+    return missing_ids, result.matched_count, result.modified_count
 
 def add_keywords_by_id(material_ids, keywords, path_to_my_db_json):
     ''' Adds keywords to mongodb docs in the materials collection (a summary doc created by builders)
@@ -14,18 +70,11 @@ def add_keywords_by_id(material_ids, keywords, path_to_my_db_json):
     
     '''
 
-    atomate_db = VaspCalcDb.from_db_file(path_to_my_db_json)
-    materials_collection = atomate_db.db['materials']
-    
-    missing_ids = []
-    for mp_id in material_ids: 
-        #tests to see if the id is in the database 
-        found = materials_collection.find_one({'mpids': mp_id})
-        if found is not None:
-            materials_collection.update_one({'mpids': mp_id}, { "$push": { "keywords": {"$each": keywords} } })
-        else:
-            missing_ids.append(mp_id)
-    
+    materials_collection = get_materials_collection(path_to_my_db_json)
+
+    missing_ids, _, _ = bulk_update_keywords(materials_collection, material_ids,
+                                             { "$push": { "keywords": {"$each": keywords} } })
+
     return missing_ids
 
 '''
@@ -48,11 +97,12 @@ def add_keywords_by_formula(pretty_formulas, keywords, path_to_my_db_json):
         missing_ids (str list): list of mp-ids that were not found in the materials collection
         
     '''
-    missing_ids = []
+    ids = []
     for formula in pretty_formulas:
-        ids = get_material_ids(formula)
-        missing = add_keywords_by_id(ids, keywords, path_to_my_db_json)
-        missing_ids.extend(missing)
+        ids.extend(get_material_ids(formula))
+
+    #update all the formulas at once, rather than reconnecting for each one
+    missing_ids = add_keywords_by_id(ids, keywords, path_to_my_db_json)
     
     if len(missing_ids) == 0:
         print("All values found and updated successfully")
@@ -73,20 +123,59 @@ def remove_keywords_by_id(material_ids, keywords_to_remove, path_to_my_db_json):
     
     '''
 
-    atomate_db = VaspCalcDb.from_db_file(path_to_my_db_json)
-    materials_collection = atomate_db.db['materials']
-    
-    missing_ids = []
-    for mp_id in material_ids: 
-        #tests to see if the id is in the database 
-        found = materials_collection.find_one({'mpids': mp_id})
-        if found is not None:
-            materials_collection.update_one({'mpids': mp_id}, { "$pullAll": { "keywords": keywords_to_remove } })
-        else:
-            missing_ids.append(mp_id)
+    materials_collection = get_materials_collection(path_to_my_db_json)
     
+    missing_ids, _, _ = bulk_update_keywords(materials_collection, material_ids,
+                                             { "$pullAll": { "keywords": keywords_to_remove } },
+                                             changes_if={'keywords': {'$in': keywords_to_remove}})
+
     if len(missing_ids) == 0:
         print("All values found and updated successfully")
     else:
         print("The following ids were not found in the database: ", missing_ids)
     return missing_ids
+
+def add_keywords_by_id_bulk(material_ids, keywords, path_to_my_db_json, chunk_size=1000):
+    ''' Same as add_keywords_by_id, but also reports how many docs were updated. Meant for tagging large campaigns
+    (thousands of mp-ids), where the ids are sent to the database in chunks of chunk_size.
+
+    Parameters:
+        material_ids (str list): the mp-ids of the substances you want to update, e.g. ["mp-123", "mp-234"]
+        keywords (str list): the keywords you would like added to the document, e.g. ["09/2021", "battery material"]
+        path_to_my_db_json (str): the path to your db.sjon file, eg. '/home/calebh27/atomate/config/db.json'
+        chunk_size (int): the number of mp-ids sent to the database in each query and update
+
+    Returns:
+        missing_ids (str list): mp-ids that were not found in the database
+        matched_count (int): the number of docs matched by the updates
+        modified_count (int): the number of docs that were actually changed
+
+    '''
+
+    materials_collection = get_materials_collection(path_to_my_db_json)
+
+    return bulk_update_keywords(materials_collection, material_ids,
+                                { "$push": { "keywords": {"$each": keywords} } }, chunk_size)
+
+def remove_keywords_by_id_bulk(material_ids, keywords_to_remove, path_to_my_db_json, chunk_size=1000):
+    ''' Same as remove_keywords_by_id, but also reports how many docs were updated. Meant for large campaigns
+    (thousands of mp-ids), where the ids are sent to the database in chunks of chunk_size.
+
+    Parameters:
+        material_ids (str list): the mp-ids of the substances you want to update, e.g. ["mp-123", "mp-234"]
+        keywords_to_remove (str list): the keywords you would like removed from the document, e.g. ["09/2021"]
+        path_to_my_db_json (str): the path to your db.sjon file, eg. '/home/calebh27/atomate/config/db.json'
+        chunk_size (int): the number of mp-ids sent to the database in each query and update
+
+    Returns:
+        missing_ids (str list): mp-ids that were not found in the database
+        matched_count (int): the number of docs that had one of the keywords
+        modified_count (int): the number of docs that were actually changed
+
+    '''
+
+    materials_collection = get_materials_collection(path_to_my_db_json)
+
+    return bulk_update_keywords(materials_collection, material_ids,
+                                { "$pullAll": { "keywords": keywords_to_remove } }, chunk_size,
+                                changes_if={'keywords': {'$in': keywords_to_remove}})
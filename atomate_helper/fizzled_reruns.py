@@ -0,0 +1,190 @@
+'''Finds the FIZZLED fireworks in the launchpad and reruns or resubmits them, without having to run
+"lpad get_wflows -s FIZZLED -d ids" and look the ids up in the dataframe from when the workflows were added.
+
+The fireworks are read with three projected queries (the fizzled fireworks, the error saved in their last launch, and
+the mp-id saved in their workflow's metadata, see duplicate_index.py), and each is given a failure signature: the last
+line of the error, with the numbers taken out, so the same error on different structures is grouped together.
+Fireworks whose launch has no error saved (e.g. jobs killed for running out of walltime) get NO_ERROR.'''
+
+import re
+
+import pandas as pd
+
+from workflow_writers import SUBMISSION_COLUMNS, add_workflows_mpid, workflows_from_fw_ids
+
+NO_ERROR = "no error recorded"
+# the INCAR change prepare_workflow makes for small structures, applied to every structure
+LREAL_FIX = {"LREAL": "False"}
+
+# workflow is the lowest fw_id in the firework's workflow, so fireworks of the same workflow can be told apart
+FIZZLED_COLUMNS = ["fw_id", "name", "mp-id", "Workflow Type", "workflow", "signature", "error"]
+
+
+def _chunks(items, chunk_size):
+    for start in range(0, len(items), chunk_size):
+        yield items[start:start + chunk_size]
+
+def failure_signature(error):
+    '''Turns the error (stacktrace) saved for a launch into a short string that is the same for the same kind of failure
+
+    Parameters:
+        error (str): the stacktrace, or None if there is none
+    Returns:
+        signature (str): the last line of the error with the numbers replaced by N. Ex: 'ValueError: N sites are too many'
+
+    '''
+
+    lines = [line.strip() for line in (error or "").splitlines() if line.strip()]
+    if not lines:
+        return NO_ERROR
+
+    return re.sub(r"\d+(\.\d+)?", "N", lines[-1])[:200]
+
+def fizzled_fireworks(launchpad, query=None, submissions=None, chunk_size=1000):
+    '''Gets every FIZZLED firework from the launchpad, with its error, failure signature, and the mp-id and type of
+    its workflow.
+
+    Parameters:
+        launchpad (object): the launchpad
+        query (dict): other conditions the fireworks have to meet. Ex: {'name': {'$regex': 'static dielectric'}}
+        submissions (Pandas dataframe): the dataframe(s) returned when the workflows were added, used to find the mp-id
+            of workflows that were added without the mp-id in their metadata (optional)
+        chunk_size (int): the number of ids sent in each $in query
+    Returns:
+        fizzled: A pandas dataframe with the fw_id, name, mp-id, Workflow Type, workflow, signature and error of each
+                 firework
+
+    '''
+
+    criteria = {"state": "FIZZLED"}
+    criteria.update(query or {})
+
+    fireworks = list(launchpad.fireworks.find(criteria, {"_id": 0, "fw_id": 1, "name": 1, "launches": 1}))
+    fw_ids = [firework["fw_id"] for firework in fireworks]
+
+    # the error from the last launch of each firework
+    last_launches = [firework["launches"][-1] for firework in fireworks if firework.get("launches")]
+    errors = {}
+    for chunk in _chunks(last_launches, chunk_size):
+        for launch in launchpad.launches.find({"launch_id": {"$in": chunk}},
+                                              {"_id": 0, "fw_id": 1, "action.stored_data._exception._stacktrace": 1}):
+            exception = ((launch.get("action") or {}).get("stored_data") or {}).get("_exception") or {}
+            errors[launch["fw_id"]] = exception.get("_stacktrace")
+
+    # the mp-id and type saved with each workflow
+    workflow_info = {}
+    for chunk in _chunks(fw_ids, chunk_size):
+        for workflow in launchpad.workflows.find({"nodes": {"$in": chunk}},
+                                                 {"_id": 0, "nodes": 1, "metadata.mp_id": 1, "metadata.workflow_type": 1}):
+            metadata = workflow.get("metadata", {})
+            for fw_id in workflow["nodes"]:
+                workflow_info[fw_id] = (metadata.get("mp_id"), metadata.get("workflow_type"), min(workflow["nodes"]))
+
+    rows = []
+    for firework in fireworks:
+        fw_id = firework["fw_id"]
+        mp_id, workflow_type, workflow = workflow_info.get(fw_id, (None, None, fw_id))
+        error = errors.get(fw_id)
+        rows.append([fw_id, firework.get("name"), mp_id, workflow_type, workflow, failure_signature(error), error])
+
+    fizzled = pd.DataFrame(rows, columns=FIZZLED_COLUMNS)
+
+    if submissions is not None and fizzled["mp-id"].isna().any():
+        unknown = fizzled["mp-id"].isna()
+        matches = workflows_from_fw_ids(submissions, fizzled.loc[unknown, "fw_id"]).set_index("fw_id")
+        fizzled.loc[unknown, "mp-id"] = fizzled.loc[unknown, "fw_id"].map(matches["mp-id"])
+        fizzled.loc[unknown, "Workflow Type"] = fizzled.loc[unknown, "fw_id"].map(matches["Workflow Type"])
+
+    return fizzled
+
+def print_fizzled_summary(fizzled):
+    '''Prints how many fireworks failed with each signature, most common first'''
+
+    print("{} fizzled fireworks:".format(len(fizzled)))
+    for signature, count in fizzled["signature"].value_counts().items():
+        print(" {:>6}  {}".format(count, signature))
+
+def _select(fizzled, signatures):
+    if signatures is None:
+        return fizzled
+    if isinstance(signatures, str):
+        signatures = [signatures]
+    return fizzled[fizzled["signature"].isin(signatures)]
+
+def rerun_fizzled(launchpad, fizzled, signatures=None):
+    '''Reruns the fizzled fireworks as they are (for failures that had nothing to do with the calculation, like a node
+    going down or running out of walltime)
+
+    Parameters:
+        launchpad (object): the launchpad
+        fizzled (Pandas dataframe): the dataframe returned by fizzled_fireworks
+        signatures (str or str list): only rerun the fireworks with these signatures (None reruns all of them)
+    Returns:
+        rerun_ids (int list): the fw_ids that were rerun
+
+    '''
+
+    rerun_ids = []
+    for fw_id in _select(fizzled, signatures)["fw_id"]:
+        try:
+            launchpad.rerun_fw(int(fw_id))
+            rerun_ids.append(int(fw_id))
+        except Exception as error:
+            print("Error: firework {} was not rerun: {!r}".format(fw_id, error))
+
+    print("Reran {} fireworks".format(len(rerun_ids)))
+    return rerun_ids
+
+def resubmit_fizzled(launchpad, fizzled, signatures=None, incar_update=LREAL_FIX, batch_size=100, pause=0,
+                     max_workers=1, target_backlog=None):
+    '''Defuses the workflows of the fizzled fireworks, and adds them again (as new workflows of the same type, for the
+    same mp-ids) with the INCAR changed, for failures that need different settings to work. An mp-id is only added
+    again if all of its workflows were defused, so it never ends up with two active workflows.
+
+    Parameters:
+        launchpad (object): the launchpad
+        fizzled (Pandas dataframe): the dataframe returned by fizzled_fireworks
+        signatures (str or str list): only resubmit the fireworks with these signatures (None resubmits all of them)
+        incar_update (dict): the INCAR settings to change in every calculation. Ex: {'LREAL': 'False'}, {'ALGO': 'All'}
+        batch_size, pause, max_workers, target_backlog: passed on to add_workflows_mpid
+    Returns:
+        df: A pandas dataframe containing the firetask ids, formula, mp-id and workflow type of each workflow added
+
+    '''
+
+    selected = _select(fizzled, signatures)
+
+    unknown = selected[selected["mp-id"].isna() | selected["Workflow Type"].isna()]
+    if len(unknown):
+        print("Skipping {} fireworks whose mp-id or workflow type is not known (pass submissions to fizzled_fireworks): ".format(len(unknown)),
+              unknown["fw_id"].tolist())
+    selected = selected.drop(unknown.index)
+
+    added = []
+    for workflow_type, workflow_fizzles in selected.groupby("Workflow Type", sort=False):
+        # one firework per workflow is enough to defuse it
+        workflow_fizzles = workflow_fizzles.drop_duplicates("workflow")
+
+        not_defused = set()
+        for fw_id, mp_id in zip(workflow_fizzles["fw_id"], workflow_fizzles["mp-id"]):
+            try:
+                launchpad.defuse_wf(int(fw_id))
+            except Exception as error:
+                print("Error: the workflow of firework {} was not defused: {!r}".format(fw_id, error))
+                not_defused.add(mp_id)
+
+        if not_defused:
+            print("Not resubmitting these mp-ids, since their {} workflow could not be defused: ".format(workflow_type),
+                  sorted(not_defused))
+        mp_ids = [mp_id for mp_id in workflow_fizzles["mp-id"].drop_duplicates() if mp_id not in not_defused]
+        if not mp_ids:
+            continue
+
+        added.append(add_workflows_mpid(mp_ids, workflow_type, launchpad,
+                                        batch_size=batch_size, pause=pause, max_workers=max_workers,
+                                        incar_update=incar_update, duplicate_policy='force',
+                                        target_backlog=target_backlog))
+
+    if not added:
+        return pd.DataFrame([], columns=SUBMISSION_COLUMNS)
+    return pd.concat(added, ignore_index=True)
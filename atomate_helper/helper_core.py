@@ -1,28 +1,111 @@
 from pymatgen.ext.matproj import MPRester
+from mp_cache import cache_get, cache_set_many
 
 # get the API Key
 with open("api_key.txt",'r') as filename:
     API_KEY = filename.readlines()[0]
 
-def get_pretty_formula(mp_id):
-    '''Given a mp-id (str), queries the MP Database and returns the corresponding pretty formula (str)'''
+def get_pretty_formula(mp_id, use_cache=True):
+    '''Given a mp-id (str), queries the MP Database and returns the corresponding pretty formula (str). The answer is
+    saved in the local cache (see mp_cache.py), unless use_cache is False, in which case the MP is always asked.'''
+
+    if use_cache:
+        pretty_formula = cache_get("pretty_formula:" + mp_id)
+        if pretty_formula is not None:
+            return pretty_formula
 
     with MPRester(API_KEY) as m:
         structure = m.query(criteria={"task_id": mp_id}, properties=["pretty_formula"])
 
-    return structure[0]["pretty_formula"]
+    pretty_formula = structure[0]["pretty_formula"]
+
+    if use_cache:
+        cache_set_many({"pretty_formula:" + mp_id: pretty_formula})
+
+    return pretty_formula
+
+def iter_structures(mp_ids, chunk_size=500):
+    '''Gets the structures and pretty formulas for a list of mp-ids from the MP Database, using one session and one
+    query per chunk of ids (instead of a new MPRester and a query for every id), and hands back the results one chunk
+    at a time. The formulas are also saved in the local cache, so later get_pretty_formula calls for these ids don't
+    need the MP.
+
+    Parameters:
+        mp_ids (str list): list of mp-ids. Ex: ['mp-594', 'mp-1547']
+        chunk_size (int): the number of mp-ids asked for in each query
+
+    Yields:
+        structures (dict): the pymatgen structure for each mp-id of the chunk that was found
+        pretty_formulas (dict): the pretty formula for each mp-id of the chunk that was found
+        missing_ids (str list): mp-ids of the chunk that the MP did not return
+
+    '''
+
+    unique_ids = list(dict.fromkeys(mp_ids))
+
+    with MPRester(API_KEY) as m:
+        for start in range(0, len(unique_ids), chunk_size):
+            chunk = unique_ids[start:start + chunk_size]
+            material_data = m.query(criteria={"task_id": {"$in": chunk}},
+                                    properties=["task_id", "structure", "pretty_formula"])
+
+            structures = {}
+            pretty_formulas = {}
+            for entry in material_data:
+                structures[entry["task_id"]] = entry["structure"]
+                pretty_formulas[entry["task_id"]] = entry["pretty_formula"]
+
+            cache_set_many({"pretty_formula:" + mp_id: formula for mp_id, formula in pretty_formulas.items()})
+
+            missing_ids = [mp_id for mp_id in chunk if mp_id not in structures]
+            if missing_ids:
+                print("The following ids were not found in the Materials Project: ", missing_ids)
+
+            yield structures, pretty_formulas, missing_ids
 
-def get_material_ids(pretty_formula):
+def get_structures(mp_ids, chunk_size=500):
+    '''Same as iter_structures, but returns the results for all of the mp-ids together
+
+    Parameters:
+        mp_ids (str list): list of mp-ids. Ex: ['mp-594', 'mp-1547']
+        chunk_size (int): the number of mp-ids asked for in each query
+
+    Returns:
+        structures (dict): the pymatgen structure for each mp-id that was found
+        pretty_formulas (dict): the pretty formula for each mp-id that was found
+        missing_ids (str list): mp-ids that the MP did not return
+
+    '''
+
+    structures = {}
+    pretty_formulas = {}
+    missing_ids = []
+
+    for chunk_structures, chunk_formulas, chunk_missing in iter_structures(mp_ids, chunk_size):
+        structures.update(chunk_structures)
+        pretty_formulas.update(chunk_formulas)
+        missing_ids.extend(chunk_missing)
+
+    return structures, pretty_formulas, missing_ids
+
+def get_material_ids(pretty_formula, use_cache=True):
     """ Function that queries the materials project database for all the materials ids matching a given pretty formula
 
     Parameters:
         pretty_formula (str): The pretty formula for the compound, for example 'NiS'
+        use_cache (bool): Whether to use the local cache of MP answers (see mp_cache.py). Set to False to always
+                          ask the MP (the fresh answer is not saved either).
 
     Returns:
         material_ids (list): a string list of the material ids for the compound, for example ['mp-594', 'mp-1547']
 
     """
 
+    if use_cache:
+        material_ids = cache_get("material_ids:" + pretty_formula)
+        if material_ids is not None:
+            return material_ids
+
     material_ids = []
 
     with MPRester(API_KEY) as m:
@@ -33,14 +116,21 @@ def get_material_ids(pretty_formula):
         for entry in material_data:
             material_ids.append(entry['task_id'])
 
+    if use_cache:
+        # every id found also has this pretty formula, which saves looking it up later
+        new_entries = {"pretty_formula:" + mp_id: pretty_formula for mp_id in material_ids}
+        new_entries["material_ids:" + pretty_formula] = material_ids
+        cache_set_many(new_entries)
+
     return material_ids
 
-def get_material_id_count(pretty_formulas):
+def get_material_id_count(pretty_formulas, use_cache=True):
     """ Function that determines the number of structures in the materials database for a given pretty formula,
     and prints the number for each. 
     
     Parameters:
         pretty_formulas (str list): a list of pretty formulas. Ex. ['NiS', 'ZrO2']
+        use_cache (bool): Whether to use the local cache of MP answers (see mp_cache.py)
     Returns:
         None
     
@@ -49,16 +139,7 @@ def get_material_id_count(pretty_formulas):
     structure_count = {}
 
     for pretty_formula in pretty_formulas:
-        material_ids = []
-
-        with MPRester(API_KEY) as m:
-            #gets all the materials id's (mp-___) from the MP for the given compound
-            material_data = m.query(criteria={"pretty_formula": pretty_formula}, properties=["task_id"])
-
-            #extracts all the materials id's from the dictionary returned by the query
-            for entry in material_data:
-                material_ids.append(entry['task_id'])
-
-            structure_count[pretty_formula] = len(material_ids)
+        material_ids = get_material_ids(pretty_formula, use_cache)
+        structure_count[pretty_formula] = len(material_ids)
     
     print(structure_count)
\ No newline at end of file
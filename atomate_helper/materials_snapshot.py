@@ -0,0 +1,284 @@
+'''A local copy (a SQLite file) of part of the materials collection, so the query_db functions can answer from it
+instead of the database (pass backend="local"). It is much faster for repeated queries, e.g. while exploring the data
+in Jupyter, and it works without a network connection.
+
+sync_snapshot copies the fields in SNAPSHOT_FIELDS of every material. After the first time, it only copies the
+materials that changed since the last sync: the ones updated by the builders (_tasksbuilder.updated_at) or by the
+edit_db functions (last_updated). Run it again whenever you want the local copy brought up to date.'''
+
+import sqlite3
+from datetime import datetime
+from collections import Counter
+
+from bson import json_util
+
+from db_connection import get_materials_collection
+from doc_paths import collapse_projection, get_field
+
+# the snapshot file is kept next to api_key.txt and db.json
+SNAPSHOT_FILE = "materials_snapshot.sqlite"
+
+# the parts of each materials doc that are copied (dot-paths copy only that part of the doc)
+SNAPSHOT_FIELDS = ["mpids", "formula_pretty", "sg_symbol", "keywords", "dielectric", "_tasksbuilder.prop_metadata.energies"]
+
+# the fields that are set when a materials doc changes
+TIMESTAMP_FIELDS = ["_tasksbuilder.updated_at", "last_updated"]
+
+# the most ids put in one SQLite query
+_SQLITE_CHUNK = 900
+
+# datetimes are read back the same way MongoDB returns them
+_JSON_OPTIONS = json_util.JSONOptions(tz_aware=False)
+
+
+def _connect(snapshot_file):
+    '''Opens the snapshot file, creating the tables the first time'''
+
+    connection = sqlite3.connect(snapshot_file or SNAPSHOT_FILE, timeout=30)
+    connection.executescript('''CREATE TABLE IF NOT EXISTS materials (key TEXT PRIMARY KEY, doc TEXT);
+                                CREATE TABLE IF NOT EXISTS material_ids (mp_id TEXT, key TEXT);
+                                CREATE INDEX IF NOT EXISTS material_ids_mp_id ON material_ids (mp_id);
+                                CREATE INDEX IF NOT EXISTS material_ids_key ON material_ids (key);
+                                CREATE TABLE IF NOT EXISTS material_keywords (keyword TEXT, key TEXT);
+                                CREATE INDEX IF NOT EXISTS material_keywords_keyword ON material_keywords (keyword);
+                                CREATE INDEX IF NOT EXISTS material_keywords_key ON material_keywords (key);
+                                CREATE TABLE IF NOT EXISTS sync_info (name TEXT PRIMARY KEY, value TEXT);''')
+    return connection
+
+def _get_info(connection, name):
+    row = connection.execute("SELECT value FROM sync_info WHERE name = ?", (name,)).fetchone()
+    return None if row is None else json_util.loads(row[0], json_options=_JSON_OPTIONS)
+
+def _set_info(connection, name, value):
+    connection.execute("INSERT OR REPLACE INTO sync_info (name, value) VALUES (?, ?)",
+                       (name, json_util.dumps(value, json_options=_JSON_OPTIONS)))
+
+def _as_list(value):
+    # like mongodb, a single value is treated as a list of one
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+def _save_materials(connection, materials):
+    '''Adds (or replaces) a batch of materials docs in the snapshot'''
+
+    keys = [(str(material.pop("_id")),) for material in materials]
+
+    connection.executemany("DELETE FROM material_ids WHERE key = ?", keys)
+    connection.executemany("DELETE FROM material_keywords WHERE key = ?", keys)
+    connection.executemany("INSERT OR REPLACE INTO materials (key, doc) VALUES (?, ?)",
+                           [(key, json_util.dumps(material, json_options=_JSON_OPTIONS))
+                            for (key,), material in zip(keys, materials)])
+    connection.executemany("INSERT INTO material_ids (mp_id, key) VALUES (?, ?)",
+                           [(mp_id, key) for (key,), material in zip(keys, materials) for mp_id in _as_list(material.get("mpids"))])
+    connection.executemany("INSERT INTO material_keywords (keyword, key) VALUES (?, ?)",
+                           [(keyword, key) for (key,), material in zip(keys, materials)
+                            for keyword in set(_as_list(material.get("keywords"))) if isinstance(keyword, str)])
+
+def _remove_deleted(connection, materials_collection):
+    '''Removes the materials that are no longer in the database'''
+
+    remote_keys = {str(material["_id"]) for material in materials_collection.find({}, {"_id": 1})}
+    local_keys = [key for (key,) in connection.execute("SELECT key FROM materials")]
+    deleted = [(key,) for key in local_keys if key not in remote_keys]
+
+    for table in ("materials", "material_ids", "material_keywords"):
+        connection.executemany("DELETE FROM {} WHERE key = ?".format(table), deleted)
+
+    return len(deleted)
+
+def sync_snapshot(path_to_my_db_json, snapshot_file=None, fields=None, full=False, batch_size=1000):
+    '''Brings the local snapshot up to date with the materials collection, copying only the materials that changed
+    since the last sync (or all of them the first time, when full is True, or when the fields are changed)
+
+    Parameters:
+        path_to_my_db_json (str): the path to your db.json file, eg. '/home/calebh27/atomate/config/db.json'
+        snapshot_file (str): the snapshot file to use (defaults to SNAPSHOT_FILE)
+        fields (str list): the parts of each doc to copy (defaults to SNAPSHOT_FIELDS). Ex. ['mpids', 'elasticity']
+        full (bool): throw away the snapshot and copy every material again
+        batch_size (int): the number of docs read from the database and written to the file at a time
+    Returns:
+        copied (int): the number of materials that were copied
+
+    '''
+
+    fields = list(SNAPSHOT_FIELDS if fields is None else fields)
+    materials_collection = get_materials_collection(path_to_my_db_json)
+
+    connection = _connect(snapshot_file)
+    try:
+        if not full and _get_info(connection, "fields") not in (None, fields):
+            print("The snapshot has different fields than the ones asked for, so every material is copied again")
+            full = True
+
+        # the newest time seen in each of the TIMESTAMP_FIELDS (kept apart, since they are set by different computers)
+        last_sync = None if full else _get_info(connection, "last_sync")
+        query = {}
+        if last_sync is not None:
+            # $gte, so docs changed in the same instant as the newest one already copied are not missed
+            query = {"$or": [{field: {"$exists": True} if last_sync.get(field) is None else {"$gte": last_sync[field]}}
+                             for field in TIMESTAMP_FIELDS]}
+
+        projection = collapse_projection(fields + TIMESTAMP_FIELDS, {"_id": 1})
+
+        copied = 0
+        newest = dict(last_sync or {})
+        with connection:
+            if full:
+                for table in ("materials", "material_ids", "material_keywords", "sync_info"):
+                    connection.execute("DELETE FROM {}".format(table))
+
+            batch = []
+            for material in materials_collection.find(query, projection, batch_size=batch_size):
+                for field in TIMESTAMP_FIELDS:
+                    updated = get_field(material, field)
+                    if isinstance(updated, datetime) and (newest.get(field) is None or updated > newest[field]):
+                        newest[field] = updated
+                batch.append(material)
+
+                if len(batch) == batch_size:
+                    _save_materials(connection, batch)
+                    copied += len(batch)
+                    batch = []
+
+            if batch:
+                _save_materials(connection, batch)
+                copied += len(batch)
+
+            local_count = connection.execute("SELECT COUNT(*) FROM materials").fetchone()[0]
+            if last_sync is not None and local_count > materials_collection.estimated_document_count():
+                print("Removed {} materials that are no longer in the database".format(
+                    _remove_deleted(connection, materials_collection)))
+
+            _set_info(connection, "fields", fields)
+            _set_info(connection, "last_sync", newest)
+    finally:
+        connection.close()
+
+    print("Copied {} materials to the snapshot".format(copied))
+    return copied
+
+def snapshot_fields(snapshot_file=None):
+    '''Returns the fields copied into the snapshot (None if it has never been synced)'''
+
+    connection = _connect(snapshot_file)
+    try:
+        return _get_info(connection, "fields")
+    finally:
+        connection.close()
+
+def _open_synced(snapshot_file):
+    '''Opens the snapshot file, raising an error if it has never been synced'''
+
+    connection = _connect(snapshot_file)
+    if _get_info(connection, "fields") is None:
+        connection.close()
+        raise RuntimeError("The materials snapshot is empty, run materials_snapshot.sync_snapshot(path_to_my_db_json) first")
+    return connection
+
+def _load(doc):
+    return json_util.loads(doc, json_options=_JSON_OPTIONS)
+
+def snapshot_materials(snapshot_file=None):
+    '''Returns every materials doc in the snapshot (like materials_collection.find({}))'''
+
+    connection = _open_synced(snapshot_file)
+    try:
+        return [_load(doc) for (doc,) in connection.execute("SELECT doc FROM materials")]
+    finally:
+        connection.close()
+
+def snapshot_materials_with_keywords(all_of=None, any_of=None, none_of=None, prefix=None, snapshot_file=None):
+    '''Returns the materials docs in the snapshot that match the keyword conditions (the same ones as
+    query_db.keyword_filter), using the keyword index of the snapshot
+
+    Parameters:
+        all_of (str list): keywords the material must have all of
+        any_of (str list): keywords the material must have at least one of
+        none_of (str list): keywords the material must not have
+        prefix (str or str list): the material must have a keyword starting with this (or one of these). Ex. '09/'
+        snapshot_file (str): the snapshot file to use (defaults to SNAPSHOT_FILE)
+    Returns:
+        materials (list): the matching docs
+
+    '''
+
+    conditions = []
+    parameters = []
+
+    def placeholders(values):
+        parameters.extend(values)
+        return ",".join("?" * len(values))
+
+    if all_of:
+        all_of = list(set(all_of))
+        conditions.append('''key IN (SELECT key FROM material_keywords WHERE keyword IN ({}) GROUP BY key
+                                     HAVING COUNT(DISTINCT keyword) = ?)'''.format(placeholders(all_of)))
+        parameters.append(len(all_of))
+    if any_of:
+        conditions.append("key IN (SELECT key FROM material_keywords WHERE keyword IN ({}))".format(placeholders(list(any_of))))
+    if none_of:
+        conditions.append("key NOT IN (SELECT key FROM material_keywords WHERE keyword IN ({}))".format(placeholders(list(none_of))))
+    if prefix:
+        prefixes = [prefix] if isinstance(prefix, str) else list(prefix)
+        # a range on the keyword index: every string starting with the prefix sorts between these two
+        conditions.append("key IN (SELECT key FROM material_keywords WHERE {})".format(
+            " OR ".join("(keyword >= ? AND keyword < ?)" for _ in prefixes)))
+        for start in prefixes:
+            parameters.extend([start, start + "\U0010ffff"])
+
+    statement = "SELECT doc FROM materials"
+    if conditions:
+        statement += " WHERE " + " AND ".join(conditions)
+
+    connection = _open_synced(snapshot_file)
+    try:
+        return [_load(doc) for (doc,) in connection.execute(statement, parameters)]
+    finally:
+        connection.close()
+
+def snapshot_materials_with_keyword(keyword, snapshot_file=None):
+    '''Returns the materials docs in the snapshot that have the keyword (like find({'keywords': keyword}))'''
+
+    return snapshot_materials_with_keywords(all_of=[keyword], snapshot_file=snapshot_file)
+
+def snapshot_materials_by_ids(mp_ids, snapshot_file=None):
+    '''Looks up a list of mp-ids in the snapshot (the same as query_db.find_materials_by_ids does in the database)
+
+    Parameters:
+        mp_ids (str list): the mp-ids to find. eg. ["mp-594", "mp-1547"]
+        snapshot_file (str): the snapshot file to use (defaults to SNAPSHOT_FILE)
+    Returns:
+        materials (list): the doc for each mp-id in mp_ids, in the same order (None if it was not found)
+        missing_ids (str list): mp-ids that were not found in the snapshot
+        duplicate_ids (str list): mp-ids that were given more than once
+
+    '''
+
+    id_counts = Counter(mp_ids)
+    unique_ids = list(id_counts)
+    duplicate_ids = [mp_id for mp_id, count in id_counts.items() if count > 1]
+
+    found = {}
+    connection = _open_synced(snapshot_file)
+    try:
+        for start in range(0, len(unique_ids), _SQLITE_CHUNK):
+            chunk = unique_ids[start:start + _SQLITE_CHUNK]
+            rows = connection.execute('''SELECT material_ids.mp_id, materials.key, materials.doc FROM material_ids
+                                         JOIN materials ON materials.key = material_ids.key
+                                         WHERE material_ids.mp_id IN ({}) ORDER BY materials.rowid'''.format(",".join("?" * len(chunk))),
+                                      chunk)
+            loaded = {}
+            for mp_id, key, doc in rows:
+                # like find_one, keep the first doc found for an id
+                if mp_id not in found:
+                    if key not in loaded:
+                        loaded[key] = _load(doc)
+                    found[mp_id] = loaded[key]
+    finally:
+        connection.close()
+
+    materials = [found.get(mp_id) for mp_id in mp_ids]
+    missing_ids = [mp_id for mp_id in unique_ids if mp_id not in found]
+
+    return materials, missing_ids, duplicate_ids
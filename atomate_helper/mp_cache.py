@@ -0,0 +1,112 @@
+'''A small on-disk cache (a SQLite file) for answers from the Materials Project, used by helper_core so that looking
+up the same mp-ids or pretty formulas again (e.g. when re-running a campaign) does not call the MP API.
+
+Entries expire after CACHE_TTL_DAYS, and once there are more than CACHE_MAX_ENTRIES, the ones that have gone unused the
+longest are removed. Delete the file, or call clear_cache(), to start over.'''
+
+import json
+import sqlite3
+import time
+
+# the cache file is kept next to api_key.txt and db.json
+CACHE_FILE = "mp_cache.sqlite"
+CACHE_TTL_DAYS = 30
+CACHE_MAX_ENTRIES = 100000
+
+
+def _connect(cache_file):
+    '''Opens the cache file, creating the table the first time'''
+
+    connection = sqlite3.connect(cache_file, timeout=30)
+    connection.execute('''CREATE TABLE IF NOT EXISTS cache
+                          (key TEXT PRIMARY KEY, value TEXT, created REAL, last_used REAL)''')
+    connection.execute("CREATE INDEX IF NOT EXISTS cache_last_used ON cache (last_used)")
+    return connection
+
+def cache_get_many(keys, cache_file=None):
+    '''Looks up several keys at once.
+
+    Parameters:
+        keys (str list): the keys to look up, e.g. ["pretty_formula:mp-594"]
+        cache_file (str): the cache file to use (defaults to CACHE_FILE)
+    Returns:
+        values (dict): the cached value for each key that was found and has not expired
+
+    '''
+
+    if not keys:
+        return {}
+
+    now = time.time()
+    oldest_allowed = now - CACHE_TTL_DAYS * 24 * 3600
+    values = {}
+
+    connection = _connect(cache_file or CACHE_FILE)
+    try:
+        with connection:
+            keys = list(keys)
+            # sqlite limits the number of ? in one statement
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = connection.execute("SELECT key, value, created FROM cache WHERE key IN ({})".format(placeholders),
+                                          chunk).fetchall()
+
+                for key, value, created in rows:
+                    if created >= oldest_allowed:
+                        values[key] = json.loads(value)
+
+                connection.execute("DELETE FROM cache WHERE created < ?", (oldest_allowed,))
+                connection.executemany("UPDATE cache SET last_used = ? WHERE key = ?", [(now, key) for key in values])
+    finally:
+        connection.close()
+
+    return values
+
+def cache_get(key, cache_file=None):
+    '''Returns the cached value for key, or None if it is not in the cache (or has expired)'''
+
+    return cache_get_many([key], cache_file).get(key)
+
+def cache_set_many(items, cache_file=None):
+    '''Stores several values at once (anything that can be saved as json), then removes the least recently used
+    entries if there are more than CACHE_MAX_ENTRIES.
+
+    Parameters:
+        items (dict): the values to store, keyed by the cache key, e.g. {"pretty_formula:mp-594": "NiS"}
+        cache_file (str): the cache file to use (defaults to CACHE_FILE)
+    Returns:
+        None
+
+    '''
+
+    if not items:
+        return
+
+    now = time.time()
+
+    connection = _connect(cache_file or CACHE_FILE)
+    try:
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                                   [(key, json.dumps(value), now, now) for key, value in items.items()])
+            connection.execute('''DELETE FROM cache WHERE key IN
+                                  (SELECT key FROM cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)''',
+                               (CACHE_MAX_ENTRIES,))
+    finally:
+        connection.close()
+
+def cache_set(key, value, cache_file=None):
+    '''Stores one value in the cache'''
+
+    cache_set_many({key: value}, cache_file)
+
+def clear_cache(cache_file=None):
+    '''Removes everything from the cache'''
+
+    connection = _connect(cache_file or CACHE_FILE)
+    try:
+        with connection:
+            connection.execute("DELETE FROM cache")
+    finally:
+        connection.close()
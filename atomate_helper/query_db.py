@@ -2,12 +2,195 @@
 which is created by running run_builder.py'''
 
 from helper_core import get_material_ids
-from atomate.vasp.database import VaspCalcDb
+from db_connection import get_materials_collection
+from doc_paths import NOT_FOUND, collapse_projection, get_path
+from materials_snapshot import TIMESTAMP_FIELDS, snapshot_fields, snapshot_materials, snapshot_materials_by_ids, snapshot_materials_with_keywords
 from pymatgen.core import Structure
+from collections import Counter
+from itertools import islice
+import re
 import numpy as np
 import pandas as pd
 
-def get_all_structures(path_to_my_db_json, additional_properties = []):
+# where the builders store the extra properties (e.g. 'epsilon_ionic') of each material
+METADATA_PATH = "_tasksbuilder.prop_metadata.energies"
+
+def build_projection(properties_to_query):
+    '''Turns a list of properties into a mongodb projection, so that only those fields are sent back by the database
+    instead of the whole materials doc. Each property is looked for on the first level of the doc, and in the
+    metadata section (see METADATA_PATH), so both places are included.
+
+    Parameters:
+        properties_to_query (str list): the properties that will be read from each doc. Ex. ['formula_pretty', 'epsilon_ionic']
+    Returns:
+        projection (dict): the projection to pass to find(). Ex. {'formula_pretty': 1, '_tasksbuilder.prop_metadata.energies.formula_pretty': 1, ...}
+
+    '''
+
+    paths = []
+    for material_property in properties_to_query:
+        paths.append(material_property)
+        if not material_property.startswith("_tasksbuilder"):
+            paths.append(METADATA_PATH + "." + material_property)
+
+    return collapse_projection(paths, {'_id': 0})
+
+# what is put in the DataFrame when a (non-numeric) property is not found. Missing numbers are NaN instead.
+MISSING = "N/A"
+
+def compile_property_paths(properties_to_query):
+    '''Works out, once per query, where each property can be found in a materials doc: first on the first level of the
+    doc, then in the metadata section. Properties can also be dot-paths into the doc, e.g. 'dielectric.epsilon_static'.
+
+    Parameters:
+        properties_to_query (str list): the properties to read from each doc
+    Returns:
+        property_paths (list): for each property, a list of the key paths (tuples of keys) to try, in order
+
+    '''
+
+    property_paths = []
+    for material_property in properties_to_query:
+        paths = [tuple(material_property.split("."))]
+        if not material_property.startswith("_tasksbuilder"):
+            paths.append(tuple(METADATA_PATH.split(".")) + (material_property,))
+        property_paths.append(paths)
+
+    return property_paths
+
+def _is_number(value):
+    return isinstance(value, (int, float, np.number)) and not isinstance(value, (bool, np.bool_))
+
+def typed_column(values):
+    '''Turns the values read for one property into a column with a proper dtype: if every value that was found is a
+    number the column is numeric (NaN where the value was missing), otherwise missing values become MISSING'''
+
+    found = [value for value in values if value is not NOT_FOUND]
+
+    if found and all(_is_number(value) for value in found):
+        if len(found) == len(values):
+            return np.array(values)
+        return np.array([np.nan if value is NOT_FOUND else value for value in values], dtype=float)
+
+    return [MISSING if value is NOT_FOUND else value for value in values]
+
+def materials_to_dataframe(materials, properties_to_query, property_names, property_paths=None):
+    '''Builds a DataFrame out of materials docs, with one column for each property (looked for on the first level of
+    the doc, and then in the metadata section). The docs are read in a single pass, filling one column at a time.
+
+    Parameters:
+        materials (iterable): the materials docs, e.g. a cursor returned by find()
+        properties_to_query (str list): the properties to read from each doc
+        property_names (str list): the column name to use for each property
+        property_paths (list): the result of compile_property_paths(properties_to_query), if it was already worked out
+    Returns:
+        df: a pandas DataFrame with one row per doc. Numeric columns hold NaN for missing values, others hold "N/A"
+
+    '''
+
+    if property_paths is None:
+        property_paths = compile_property_paths(properties_to_query)
+
+    columns = [[] for _ in property_paths]
+
+    for material in materials:
+        for column, paths in zip(columns, property_paths):
+            value = NOT_FOUND
+            for keys in paths:
+                value = get_path(material, keys)
+                if value is not NOT_FOUND:
+                    break
+            column.append(value)
+
+    # built by position, so repeated column names are kept
+    df = pd.DataFrame({position: typed_column(column) for position, column in enumerate(columns)})
+    df.columns = property_names
+
+    return df
+
+def find_materials_by_ids(materials_collection, mp_ids, projection=None, chunk_size=1000, query=None):
+    '''Looks up a list of mp-ids in the materials collection, using one $in query per chunk of ids instead of a
+    find_one for each id, and then puts the docs back in the same order as the ids that were given.
+
+    Parameters:
+        materials_collection (object): the materials collection, e.g. get_materials_collection(path_to_my_db_json)
+        mp_ids (str list): the mp-ids to find. eg. ["mp-594", "mp-1547"]
+        projection (dict): which fields of the docs to return (None returns the whole doc)
+        chunk_size (int): the number of mp-ids sent to the database in each query
+        query (dict): other conditions the docs have to meet, e.g. from property_filter (ids whose doc does not meet
+                      them are treated as not found)
+    Returns:
+        materials (list): the doc for each mp-id in mp_ids, in the same order (None if it was not found)
+        missing_ids (str list): mp-ids that were not found in the database
+        duplicate_ids (str list): mp-ids that were given more than once
+
+    '''
+
+    # the mpids field is needed to match the docs back to the ids
+    if projection is not None:
+        projection = dict(projection, mpids=1)
+
+    id_counts = Counter(mp_ids)
+    unique_ids = list(id_counts)
+    duplicate_ids = [mp_id for mp_id, count in id_counts.items() if count > 1]
+
+    found = {}
+    for start in range(0, len(unique_ids), chunk_size):
+        chunk = unique_ids[start:start + chunk_size]
+        chunk_set = set(chunk)
+
+        criteria = {'mpids': {'$in': chunk}}
+        if query:
+            criteria = {'$and': [criteria, query]}
+
+        for material in materials_collection.find(criteria, projection):
+            for mp_id in material['mpids']:
+                # like find_one, keep the first doc found for an id
+                if mp_id in chunk_set and mp_id not in found:
+                    found[mp_id] = material
+
+    materials = [found.get(mp_id) for mp_id in mp_ids]
+    missing_ids = [mp_id for mp_id in unique_ids if mp_id not in found]
+
+    return materials, missing_ids, duplicate_ids
+
+def check_backend(backend, properties_to_query=(), snapshot_file=None):
+    '''Checks that backend is 'remote' (the database) or 'local' (the snapshot, see materials_snapshot.py). For the
+    local backend, prints a warning for any property that is not copied into the snapshot (it would come back as N/A)'''
+
+    if backend not in ("remote", "local"):
+        raise ValueError("backend should be 'remote' or 'local', not '{}'".format(backend))
+    if backend == "remote":
+        return
+
+    fields = snapshot_fields(snapshot_file)
+    if fields is None:
+        return
+
+    not_copied = []
+    for material_property, paths in zip(properties_to_query, compile_property_paths(properties_to_query)):
+        # a dot-path can only be at the top level, since the keys in the metadata section have no dots in them
+        full_paths = [".".join(keys) for keys in paths if not any("." in key for key in keys)]
+        if not any(path == field or path.startswith(field + ".") for path in full_paths for field in fields):
+            not_copied.append(material_property)
+
+    if not_copied:
+        print("Warning: these properties are not in the local snapshot (add them to the fields of sync_snapshot): ", not_copied)
+
+def first_mp_ids(mpids_column):
+    '''Turns a column of mpids lists into one mp-id per material (the first one in each list)'''
+
+    return [mp_ids[0] if isinstance(mp_ids, list) and mp_ids else mp_ids for mp_ids in mpids_column]
+
+def print_lookup_report(missing_ids, duplicate_ids):
+    '''Prints the ids that find_materials_by_ids could not find, or that were asked for more than once'''
+
+    if missing_ids:
+        print("The following ids were not found in the database: ", missing_ids)
+    if duplicate_ids:
+        print("The following ids were given more than once: ", duplicate_ids)
+
+def get_all_structures(path_to_my_db_json, additional_properties = [], backend="remote", snapshot_file=None):
     '''Returns basic info from the database on all structures in the materials collection, in addition to any user specified
     values from the metadata section
 
@@ -16,15 +199,13 @@ def get_all_structures(path_to_my_db_json, additional_properties = []):
         additional_properties (str list): Any additional properties that you wish to query. These must be the
                                           names that are used in the metadata section of the mongodb. Use 
                                           print_available_properties() to see options. Ex. ['epsilon_ionic']
+        backend (str): 'remote' to query the database, or 'local' to use the local snapshot (see materials_snapshot.py)
+        snapshot_file (str): the snapshot file used by the local backend (defaults to materials_snapshot.SNAPSHOT_FILE)
     Returns:
         df: a pandas DataFrame containing some basic info (formula, id, spacegroup, and keywords) on the materials
     
     '''
 
-    # set up the connection to the collection
-    atomate_db = VaspCalcDb.from_db_file(path_to_my_db_json)
-    materials_collection = atomate_db.db['materials']
-
     # define the basic properties to query
     properties_to_query = ["formula_pretty", "mpids","sg_symbol","keywords"]
     property_names = ["Pretty Formula", "mp-id", "Space Group", "Keywords"]
@@ -32,86 +213,585 @@ def get_all_structures(path_to_my_db_json, additional_properties = []):
     # include any user-specificed properties to query
     properties_to_query.extend(additional_properties)
     property_names.extend(additional_properties)
-    
-    data = []
-    
-    materials = materials_collection.find()
-    
-    for material in materials:
-        current_material_properties = []
-    
-        for material_property in properties_to_query:
-            try: # search for the property on the first level
-                current_material_properties.append(material[material_property])
-            except: # search in the metadata block
-                    try:
-                        current_material_properties.append(material["_tasksbuilder"]["prop_metadata"]["energies"][material_property])
-                    except: # property not found
-                        current_material_properties.append("N/A")
-                        
-        # add match data to a data set
-        data.append(current_material_properties)
-    
-    # convert data to a dataframe
-    df = pd.DataFrame(data, columns=property_names)
 
-    return df
+    check_backend(backend, properties_to_query, snapshot_file)
+    if backend == "local":
+        return materials_to_dataframe(snapshot_materials(snapshot_file), properties_to_query, property_names)
+
+    # set up the connection to the collection
+    materials_collection = get_materials_collection(path_to_my_db_json)
+
+    # only the fields that are needed are sent back by the database
+    materials = materials_collection.find({}, build_projection(properties_to_query))
+
+    return materials_to_dataframe(materials, properties_to_query, property_names)
+
+def iter_all_structures(path_to_my_db_json, additional_properties = [], batch_size=1000):
+    '''Same as get_all_structures, but instead of building one DataFrame for the whole materials collection, it hands
+    back a DataFrame of (at most) batch_size rows at a time, as the docs come in from the database. Use it in a for loop:
+        for df in iter_all_structures(path_to_my_db_json): ...
+
+    Parameters:
+        path_to_my_db_json (str): the path to your db.sjon file, eg. '/home/calebh27/atomate/config/db.json'
+        additional_properties (str list): Any additional properties that you wish to query (see get_all_structures)
+        batch_size (int): the number of materials in each DataFrame (also the number of docs mongodb sends at a time)
+    Yields:
+        df: a pandas DataFrame with the same columns as get_all_structures, for the next batch_size materials
+
+    '''
+
+    materials_collection = get_materials_collection(path_to_my_db_json)
+
+    properties_to_query = ["formula_pretty", "mpids","sg_symbol","keywords"] + list(additional_properties)
+    property_names = ["Pretty Formula", "mp-id", "Space Group", "Keywords"] + list(additional_properties)
 
-def query_materials_with_keyword(keyword, path_to_my_db_json):
+    materials = materials_collection.find({}, build_projection(properties_to_query), batch_size=batch_size)
+
+    return dataframe_batches(materials, properties_to_query, property_names, batch_size)
+
+def dataframe_batches(materials, properties_to_query, property_names, batch_size=1000):
+    '''Turns materials docs (e.g. a cursor) into DataFrames of (at most) batch_size rows, one batch at a time'''
+
+    materials = iter(materials)
+    property_paths = compile_property_paths(properties_to_query)
+
+    while True:
+        batch = list(islice(materials, batch_size))
+        if not batch:
+            return
+        yield materials_to_dataframe(batch, properties_to_query, property_names, property_paths)
+
+def numeric_properties(materials_collection, properties_to_query):
+    '''Finds out which properties hold numbers in every doc of the collection that has them, so that a column gets
+    the same type in every batch of an export (even batches where no doc has the property). The check is done by the
+    database, with two find_one queries for each place a property can be.
+
+    Parameters:
+        materials_collection (object): the materials collection, e.g. get_materials_collection(path_to_my_db_json)
+        properties_to_query (str list): the properties that will be read from each doc
+    Returns:
+        numeric (bool list): for each property, True if all of its values are numbers (missing values are allowed)
+
+    '''
+
+    numeric = []
+    for paths in compile_property_paths(properties_to_query):
+        found_number = False
+        found_other = False
+        for keys in paths:
+            # the keys in the metadata section have no dots in them
+            if any("." in key for key in keys):
+                continue
+            path = ".".join(keys)
+            # $type 'number' also matches lists of numbers, so lists are looked for separately
+            if materials_collection.find_one({"$or": [{path: {"$exists": True, "$ne": None, "$not": {"$type": "number"}}},
+                                                      {path: {"$type": "array"}}]}, {"_id": 1}) is not None:
+                found_other = True
+                break
+            if materials_collection.find_one({path: {"$type": "number"}}, {"_id": 1}) is not None:
+                found_number = True
+        numeric.append(found_number and not found_other)
+
+    return numeric
+
+def export_all_structures(path_to_my_db_json, output_path, additional_properties = [], batch_size=1000):
+    '''Writes the info from get_all_structures straight to a .csv or .parquet file, batch_size materials at a time,
+    so the whole collection never has to fit in memory (useful for large exports on a login node). Writing parquet
+    files requires pyarrow. Columns that are not numbers (e.g. Keywords) are stored as strings, and missing numbers as NaN.
+
+    Parameters:
+        path_to_my_db_json (str): the path to your db.sjon file, eg. '/home/calebh27/atomate/config/db.json'
+        output_path (str): the file to write, ending in .csv or .parquet. Ex. 'all_materials.parquet'
+        additional_properties (str list): Any additional properties that you wish to query (see get_all_structures)
+        batch_size (int): the number of materials read and written at a time
+    Returns:
+        row_count (int): the number of materials written to the file
+
+    '''
+
+    if output_path.endswith(".parquet"):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Writing parquet files requires pyarrow (pip install pyarrow), or use a .csv output_path instead")
+    elif not output_path.endswith(".csv"):
+        raise ValueError("output_path should end in .csv or .parquet, not: {}".format(output_path))
+
+    # every batch needs the same column types, so they are worked out once: numbers are always floats (NaN when
+    # missing) and everything else a string
+    properties_to_query = ["formula_pretty", "mpids","sg_symbol","keywords"] + list(additional_properties)
+    numeric = numeric_properties(get_materials_collection(path_to_my_db_json), properties_to_query)
+
+    row_count = 0
+    writer = None
+
+    try:
+        for df in iter_all_structures(path_to_my_db_json, additional_properties, batch_size):
+            # rebuilt by position, so repeated column names are kept
+            columns = df.columns
+            # missing values in string columns are always MISSING (a batch with only numbers in them would give NaN)
+            df = pd.DataFrame({position: pd.to_numeric(df.iloc[:, position], errors="coerce").astype("float64")
+                               if is_numeric else df.iloc[:, position].astype(object).where(df.iloc[:, position].notna(),
+                                                                                            MISSING).astype(str)
+                               for position, is_numeric in enumerate(numeric)})
+            df.columns = columns
+
+            if output_path.endswith(".csv"):
+                df.to_csv(output_path, mode="w" if row_count == 0 else "a", header=(row_count == 0), index=False)
+            else:
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(output_path, table.schema)
+                writer.write_table(table)
+
+            row_count += len(df)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return row_count
+
+def query_materials_with_keyword(keyword, path_to_my_db_json, backend="remote", snapshot_file=None):
     '''Given a keyword, returns all the materials with that keyword.
 
     Parameters:
         keyword (str): The keyword you wish to find
         path_to_my_db_json (str): the path to your db.sjon file, eg. '/home/calebh27/atomate/config/db.json'
+        backend (str): 'remote' to query the database, or 'local' to use the local snapshot (see materials_snapshot.py)
+        snapshot_file (str): the snapshot file used by the local backend (defaults to materials_snapshot.SNAPSHOT_FILE)
     Returns:
         df: a pandas DataFrame containing some basic info on the materials with the keyword
     
     '''
 
-    # set up the connection to the collection
-    atomate_db = VaspCalcDb.from_db_file(path_to_my_db_json)
-    materials_collection = atomate_db.db['materials']
-    
-    data = []
+    return query_materials_with_keywords(path_to_my_db_json, all_of=[keyword], backend=backend, snapshot_file=snapshot_file)
 
-    # Find all the docs with the keyword
-    materials_found = materials_collection.find({'keywords': keyword})
+def keyword_filter(all_of=None, any_of=None, none_of=None, prefix=None):
+    '''Builds the mongodb query for materials matching some keyword conditions (the conditions that are given must all
+    be true). It is a single query on the keywords field, so it can use the keywords index (see ensure_indexes).
 
-    for material in materials_found:
-        mp_id = material["mpids"]
-        # add match data to a data set (more can be added, as desired)
-        data.append([material["formula_pretty"], mp_id[0], material["sg_symbol"], material["keywords"]])
-    
-    # convert data to a dataframe
-    df = pd.DataFrame(data, columns=["Pretty Formula", "mp-id", "Space Group", "Keywords"])
+    Parameters:
+        all_of (str list): keywords the material must have all of. Ex. ['09/2021', 'battery material']
+        any_of (str list): keywords the material must have at least one of
+        none_of (str list): keywords the material must not have
+        prefix (str or str list): the material must have a keyword starting with this (or one of these). Ex. '09/'
+                                  for all the '09/2021'-style campaign tags from September
+    Returns:
+        query (dict): the query to pass to find()
+
+    '''
+
+    conditions = []
+    if all_of:
+        conditions.append({'keywords': {'$all': list(all_of)}})
+    if any_of:
+        conditions.append({'keywords': {'$in': list(any_of)}})
+    if none_of:
+        conditions.append({'keywords': {'$nin': list(none_of)}})
+    if prefix:
+        prefixes = [prefix] if isinstance(prefix, str) else list(prefix)
+        # a regex anchored with ^ can be answered from the index
+        conditions.append({'keywords': {'$in': [re.compile("^" + re.escape(start)) for start in prefixes]}})
+
+    if not conditions:
+        return {}
+    if len(conditions) == 1:
+        return conditions[0]
+    return {'$and': conditions}
+
+def query_materials_with_keywords(path_to_my_db_json, all_of=None, any_of=None, none_of=None, prefix=None,
+                                  additional_properties = [], backend="remote", snapshot_file=None):
+    '''Returns the materials whose keywords match all the given conditions, with one query (see keyword_filter).
+    Ex. query_materials_with_keywords(path, all_of=['battery material'], prefix='09/', none_of=['rerun'])
+
+    Parameters:
+        path_to_my_db_json (str): the path to your db.sjon file, eg. '/home/calebh27/atomate/config/db.json'
+        all_of (str list): keywords the material must have all of
+        any_of (str list): keywords the material must have at least one of
+        none_of (str list): keywords the material must not have
+        prefix (str or str list): the material must have a keyword starting with this (or one of these)
+        additional_properties (str list): Any additional properties that you wish to query (see get_all_structures)
+        backend (str): 'remote' to query the database, or 'local' to use the local snapshot (see materials_snapshot.py)
+        snapshot_file (str): the snapshot file used by the local backend (defaults to materials_snapshot.SNAPSHOT_FILE)
+    Returns:
+        df: a pandas DataFrame containing some basic info (formula, id, spacegroup, and keywords) on the materials
+
+    '''
+
+    properties_to_query = ["formula_pretty", "mpids","sg_symbol","keywords"] + list(additional_properties)
+    property_names = ["Pretty Formula", "mp-id", "Space Group", "Keywords"] + list(additional_properties)
+
+    check_backend(backend, properties_to_query, snapshot_file)
+
+    # Find all the docs with the keywords
+    if backend == "local":
+        materials_found = snapshot_materials_with_keywords(all_of, any_of, none_of, prefix, snapshot_file)
+    else:
+        # set up the connection to the collection
+        materials_collection = get_materials_collection(path_to_my_db_json)
+        materials_found = materials_collection.find(keyword_filter(all_of, any_of, none_of, prefix),
+                                                    build_projection(properties_to_query))
+
+    df = materials_to_dataframe(materials_found, properties_to_query, property_names)
+
+    # one mp-id per material
+    df["mp-id"] = first_mp_ids(df["mp-id"])
 
     return df
 
+# the fields the query and edit functions look materials up by (and sync_snapshot looks for changed materials by),
+# which should each have an index
+MATERIALS_INDEXES = ["mpids", "keywords", "formula_pretty"] + TIMESTAMP_FIELDS
+
+def ensure_indexes(path_to_my_db_json, fields=MATERIALS_INDEXES):
+    '''Makes sure the materials collection has an index on each of the fields, creating the ones that are missing.
+    Without them, every lookup by mp-id or keyword reads the whole collection. It only needs to be run once.
+
+    Parameters:
+        path_to_my_db_json (str): the path to your db.sjon file, eg. '/home/calebh27/atomate/config/db.json'
+        fields (str list): the fields to index (defaults to MATERIALS_INDEXES)
+    Returns:
+        created (str list): the fields that did not have an index yet
+
+    '''
+
+    materials_collection = get_materials_collection(path_to_my_db_json)
+
+    # the first field of each existing index (an index on several fields can still be used for its first one)
+    indexed = {index["key"][0][0] for index in materials_collection.index_information().values()}
+
+    created = []
+    for field in fields:
+        if field not in indexed:
+            materials_collection.create_index(field)
+            created.append(field)
+
+    if created:
+        print("Created indexes on: ", created)
+    else:
+        print("All the indexes already exist")
+    return created
+
+def explain_query(path_to_my_db_json, query, projection=None):
+    '''Asks mongodb how it runs a query (explain()) and prints a short summary: whether it used an index (IXSCAN) or
+    read the whole collection (COLLSCAN), and how many index keys and docs it looked at to find the results.
+
+    Parameters:
+        path_to_my_db_json (str): the path to your db.sjon file, eg. '/home/calebh27/atomate/config/db.json'
+        query (dict): the query to explain. Ex. keyword_filter(prefix='09/')
+        projection (dict): the projection used with the query, if any
+    Returns:
+        summary (dict): the stages of the plan, the indexes used, and the numbers of results, keys and docs examined
+
+    '''
+
+    materials_collection = get_materials_collection(path_to_my_db_json)
+    plan = materials_collection.find(query, projection).explain()
+
+    winning_plan = plan.get("queryPlanner", {}).get("winningPlan", {})
+    # newer versions of mongodb put the plan one level down
+    winning_plan = winning_plan.get("queryPlan", winning_plan)
+
+    stages = []
+    indexes = []
+    to_visit = [winning_plan]
+    while to_visit:
+        stage = to_visit.pop()
+        stages.append(stage.get("stage"))
+        if "indexName" in stage:
+            indexes.append(stage["indexName"])
+        if "inputStage" in stage:
+            to_visit.append(stage["inputStage"])
+        to_visit.extend(stage.get("inputStages", []))
+
+    stats = plan.get("executionStats", {})
+    summary = {"stages": stages, "indexes": indexes, "returned": stats.get("nReturned"),
+               "keys_examined": stats.get("totalKeysExamined"), "docs_examined": stats.get("totalDocsExamined"),
+               "milliseconds": stats.get("executionTimeMillis")}
+
+    print("Plan: {} (indexes used: {})".format(" <- ".join(str(stage) for stage in stages), indexes or "none"))
+    print("Returned {} docs, after examining {} index keys and {} docs, in {} ms".format(
+        summary["returned"], summary["keys_examined"], summary["docs_examined"], summary["milliseconds"]))
+    if "COLLSCAN" in stages:
+        print("The whole collection was read, run ensure_indexes() to add the missing index")
+
+    return summary
+
+def _filter_conditions(filters):
+    '''Turns the filters given to query_properties into (property, key paths, operators) for each property, with
+    equality as {'$eq': value} and ranges as {'$gte': low, '$lte': high}'''
+
+    conditions = []
+    for material_property, condition in (filters or {}).items():
+        if isinstance(condition, dict):
+            operators = dict(condition)
+        elif isinstance(condition, (tuple, list)) and len(condition) == 2:
+            low, high = condition
+            operators = {}
+            if low is not None:
+                operators["$gte"] = low
+            if high is not None:
+                operators["$lte"] = high
+        else:
+            operators = {"$eq": condition}
+
+        # a dot-path can't be found inside the metadata section (the keys there have no dots in them)
+        paths = [keys for keys in compile_property_paths([material_property])[0] if not any("." in key for key in keys)]
+        conditions.append((material_property, paths, operators))
+
+    return conditions
+
+def property_filter(filters):
+    '''Turns conditions on properties into a mongodb query, so the database only sends back the materials that meet
+    them. Like the columns, each property can be a dot-path into the doc or the name of a property in the metadata
+    section, and the condition is checked on the value in the first of those places that has it (the value that
+    would be in the column). So {'sg_symbol': {'$ne': 'F-43m'}} never matches a material whose sg_symbol is F-43m.
+
+    Parameters:
+        filters (dict): a condition for each property. The condition can be a value the property must be equal to,
+                        a (low, high) range (None for no limit), or a dict of mongodb operators.
+                        Ex. {'bandstructure.uniform_gap': (1, 3), 'sg_symbol': 'F-43m', 'epsilon_ionic': {'$exists': True}}
+    Returns:
+        query (dict): the query to pass to find(). Ex. {'bandstructure.uniform_gap': {'$gte': 1, '$lte': 3}, ...}
+
+    '''
+
+    clauses = []
+    for _, paths, operators in _filter_conditions(filters):
+        # each place is only checked if the ones before it don't have the property
+        clause = {".".join(paths[-1]): operators}
+        for keys in reversed(paths[:-1]):
+            path = ".".join(keys)
+            clause = {"$or": [{"$and": [{path: {"$exists": True}}, {path: operators}]},
+                              {"$and": [{path: {"$exists": False}}, clause]}]}
+        clauses.append(clause)
+
+    if not clauses:
+        return {}
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+def _compare(value, operator, target):
+    try:
+        if operator == "$eq":
+            return value == target or (isinstance(value, list) and target in value)
+        if operator == "$ne":
+            return not _compare(value, "$eq", target)
+        if operator == "$in":
+            return any(_compare(value, "$eq", option) for option in target)
+        if operator == "$nin":
+            return not _compare(value, "$in", target)
+        if value is None or isinstance(value, (dict, list)):
+            return False
+        if operator == "$gt":
+            return value > target
+        if operator == "$gte":
+            return value >= target
+        if operator == "$lt":
+            return value < target
+        if operator == "$lte":
+            return value <= target
+    except TypeError:
+        # like mongodb, a string is never greater or less than a number
+        return False
+    raise ValueError("The local backend can't filter with {}, use the remote backend".format(operator))
+
+def matches_filter(material, conditions):
+    '''Checks a materials doc against the result of _filter_conditions, the same way the database would (used for the
+    local snapshot, which can't run mongodb queries)'''
+
+    for _, paths, operators in conditions:
+        # the value in the first place that has the property, like the column and property_filter
+        value = NOT_FOUND
+        for keys in paths:
+            value = get_path(material, keys)
+            if value is not NOT_FOUND:
+                break
+
+        if value is not NOT_FOUND:
+            if not all(bool(target) if operator == "$exists" else _compare(value, operator, target)
+                       for operator, target in operators.items()):
+                return False
+        elif not all((operator == "$exists" and not target) or (operator in ("$ne", "$nin"))
+                     for operator, target in operators.items()):
+            # only "does not exist" or "is not" conditions are met by a missing property
+            return False
+
+    return True
+
+def _property_query(properties, property_names):
+    # the mp-id is always returned, so each row can be told apart
+    properties = list(properties)
+    property_names = list(properties if property_names is None else property_names)
+    if len(property_names) != len(properties):
+        raise ValueError("property_names should have one name for each property")
+    if "mpids" not in properties:
+        properties.insert(0, "mpids")
+        property_names.insert(0, "mp-id")
+    return properties, property_names
+
+def _with_one_mp_id(df, properties, mp_ids=None):
+    # one mp-id per material, like query_materials_with_keywords (the one asked for, if the ids were given)
+    position = properties.index("mpids")
+    df.iloc[:, position] = first_mp_ids(df.iloc[:, position]) if mp_ids is None else mp_ids
+    return df
+
+def iter_properties(path_to_my_db_json, properties, filters=None, property_names=None, batch_size=1000, backend="remote",
+                    snapshot_file=None):
+    '''Returns any properties of the materials that meet the filters, as DataFrames of (at most) batch_size rows, as
+    the docs come in from the database. Only the properties are sent back, and the filtering is done by the database.
+    Use it in a for loop:
+        for df in iter_properties(path_to_my_db_json, ['bandstructure.uniform_gap'], {'bandstructure.uniform_gap': (1, 3)}): ...
+
+    Parameters:
+        path_to_my_db_json (str): the path to your db.sjon file, eg. '/home/calebh27/atomate/config/db.json'
+        properties (str list): the properties to return, as dot-paths into the materials doc or names of properties
+                               in the metadata section. Ex. ['formula_pretty', 'dielectric.epsilon_static', 'epsilon_ionic']
+                               Use print_all_material_info() to see what is in the docs.
+        filters (dict): conditions the materials have to meet (see property_filter). Ex. {'dielectric.n': (2, None)}
+        property_names (str list): the column name for each property (defaults to the properties themselves)
+        batch_size (int): the number of materials in each DataFrame (also the number of docs mongodb sends at a time)
+        backend (str): 'remote' to query the database, or 'local' to use the local snapshot (see materials_snapshot.py)
+        snapshot_file (str): the snapshot file used by the local backend (defaults to materials_snapshot.SNAPSHOT_FILE)
+    Yields:
+        df: a pandas DataFrame with an mp-id column and a column for each property. Numeric columns hold NaN for
+            missing values, others hold "N/A"
+
+    '''
+
+    properties, property_names = _property_query(properties, property_names)
+    materials = _find_properties(path_to_my_db_json, properties, filters, batch_size, backend, snapshot_file)
+
+    return (_with_one_mp_id(df, properties) for df in dataframe_batches(materials, properties, property_names, batch_size))
+
+def _find_properties(path_to_my_db_json, properties, filters, batch_size, backend, snapshot_file=None):
+    # the materials docs that meet the filters, with only the properties in them
+    check_backend(backend, properties + list(filters or {}), snapshot_file)
+
+    if backend == "local":
+        conditions = _filter_conditions(filters)
+        return (material for material in snapshot_materials(snapshot_file) if matches_filter(material, conditions))
+
+    materials_collection = get_materials_collection(path_to_my_db_json)
+    return materials_collection.find(property_filter(filters), build_projection(properties), batch_size=batch_size)
+
+def query_properties(path_to_my_db_json, properties, filters=None, mp_ids=None, property_names=None, chunk_size=1000,
+                     backend="remote", snapshot_file=None):
+    '''Returns any properties of the materials that meet the filters (out of all the materials, or just the given
+    mp-ids) in one DataFrame. Only the properties are sent back, and the filtering is done by the database, so new
+    properties don't need a function of their own.
+        query_properties(path_to_my_db_json, ['formula_pretty', 'bandstructure.uniform_gap'],
+                         filters={'bandstructure.uniform_gap': (1, 3), 'keywords': 'perovskite'})
+
+    Parameters:
+        path_to_my_db_json (str): the path to your db.sjon file, eg. '/home/calebh27/atomate/config/db.json'
+        properties (str list): the properties to return, as dot-paths into the materials doc or names of properties
+                               in the metadata section (see iter_properties)
+        filters (dict): conditions the materials have to meet (see property_filter)
+        mp_ids (str list): only look at these materials. The rows are in the same order as the ids (None looks at
+                           every material)
+        property_names (str list): the column name for each property (defaults to the properties themselves)
+        chunk_size (int): the number of mp-ids sent to the database in each query (or docs read at a time)
+        backend (str): 'remote' to query the database, or 'local' to use the local snapshot (see materials_snapshot.py)
+        snapshot_file (str): the snapshot file used by the local backend (defaults to materials_snapshot.SNAPSHOT_FILE)
+    Returns:
+        df: a pandas DataFrame with an mp-id column (the first mp-id of each material, or the one asked for in
+            mp_ids) and a column for each property, for each material that was found and meets the filters
+
+    '''
+
+    properties, property_names = _property_query(properties, property_names)
+
+    if mp_ids is None:
+        # read in one pass (not batches), so each column gets one dtype for all the rows
+        materials = _find_properties(path_to_my_db_json, properties, filters, chunk_size, backend, snapshot_file)
+        return _with_one_mp_id(materials_to_dataframe(materials, properties, property_names), properties)
+
+    check_backend(backend, properties + list(filters or {}), snapshot_file)
+
+    if backend == "local":
+        materials, missing_ids, duplicate_ids = snapshot_materials_by_ids(mp_ids, snapshot_file)
+        conditions = _filter_conditions(filters)
+        materials = [material if material is not None and matches_filter(material, conditions) else None
+                     for material in materials]
+        missing_ids = [mp_id for mp_id, material in zip(mp_ids, materials) if material is None]
+        missing_ids = list(dict.fromkeys(missing_ids))
+    else:
+        materials_collection = get_materials_collection(path_to_my_db_json)
+        materials, missing_ids, duplicate_ids = find_materials_by_ids(materials_collection, mp_ids,
+                                                                      projection=build_projection(properties),
+                                                                      chunk_size=chunk_size,
+                                                                      query=property_filter(filters))
+
+    if filters and missing_ids:
+        print("The following ids were not found in the database, or do not meet the filters: ", missing_ids)
+        missing_ids = []
+    print_lookup_report(missing_ids, duplicate_ids)
+
+    found_ids = [mp_id for mp_id, material in zip(mp_ids, materials) if material is not None]
+    df = materials_to_dataframe([material for material in materials if material is not None], properties, property_names)
+
+    return _with_one_mp_id(df, properties, found_ids)
+
+def compare_backends(path_to_my_db_json, filters, snapshot_file=None):
+    '''Runs the same filters on the database and on the local snapshot, and prints the materials that only one of them
+    returned (because the snapshot is out of date, or the local backend handled a filter differently)
+
+    Parameters:
+        path_to_my_db_json (str): the path to your db.sjon file, eg. '/home/calebh27/atomate/config/db.json'
+        filters (dict): the conditions to check (see property_filter)
+        snapshot_file (str): the snapshot file to use (defaults to materials_snapshot.SNAPSHOT_FILE)
+    Returns:
+        agree (bool): True if both returned the same materials
+
+    '''
+
+    remote_ids = set(query_properties(path_to_my_db_json, [], filters)["mp-id"])
+    local_ids = set(query_properties(path_to_my_db_json, [], filters, backend="local", snapshot_file=snapshot_file)["mp-id"])
+
+    if remote_ids - local_ids:
+        print("Only returned by the database: ", sorted(remote_ids - local_ids))
+    if local_ids - remote_ids:
+        print("Only returned by the local snapshot: ", sorted(local_ids - remote_ids))
+
+    return remote_ids == local_ids
+
 '''
-These two function can easily be modified to get any other property simply by changing the 'the_material['dielectric']['epsilon_static']' portion
-to match the path needed. To see all the possible data that could be queried, use the print_all_material_info() function below
+To get any other property (or several at once), use query_properties above with its path instead of copying these two
+functions, e.g. query_properties(dbjson_path, ['dielectric.epsilon_static'], mp_ids=mp_ids), or get_tensor_array below
+for tensors. To see all the possible data that could be queried, use the print_all_material_info() function below
 '''
-def get_epsilon_staticM_mpid(mp_ids, dbjson_path):
+def get_epsilon_staticM_mpid(mp_ids, dbjson_path, chunk_size=1000, backend="remote", snapshot_file=None):
     ''' Returns the epsilon static matrices from a list of materials (mp-ids) in the materials collection of the mongodb
     
     Parameters:
         mp_id (str list): The mp_ids of the material in quesiton. Ex. ['mp-594', 'mp-91']
         dbjson_path (str): The path to your db.json file (which should be in the atomate/config folder). Ex. '/home/user/atomate/config/db.json'
+        chunk_size (int): The number of mp-ids sent to the database in each query
+        backend (str): 'remote' to query the database, or 'local' to use the local snapshot (see materials_snapshot.py)
+        snapshot_file (str): the snapshot file used by the local backend (defaults to materials_snapshot.SNAPSHOT_FILE)
         
     Returns:
         matrices (dict): A dictionary containing the mp-ids as keys and the epsilon static matrix as the value
         
     '''
-    
-    #connect to the materials collection
-    atomate_db = VaspCalcDb.from_db_file(dbjson_path)
-    materials_collection = atomate_db.db['materials']
-    
+
+    check_backend(backend, ['dielectric.epsilon_static'], snapshot_file)
     matrices = {}
-    
-    for mp_id in mp_ids:
-        #find the material document with matching mp-id and extract the matrix
-        the_material = materials_collection.find_one({'mpids': mp_id})
+
+    # find all the material documents with one query per chunk of ids
+    if backend == "local":
+        materials, _, duplicate_ids = snapshot_materials_by_ids(mp_ids, snapshot_file)
+    else:
+        #connect to the materials collection
+        materials_collection = get_materials_collection(dbjson_path)
+        materials, _, duplicate_ids = find_materials_by_ids(materials_collection, mp_ids,
+                                                            projection={'_id': 0, 'dielectric.epsilon_static': 1},
+                                                            chunk_size=chunk_size)
+    print_lookup_report([], duplicate_ids)
+
+    for mp_id, the_material in zip(mp_ids, materials):
+        #extract the matrix
         try:
             epsilon_static_matrix = np.array(the_material['dielectric']['epsilon_static'])
             matrices[mp_id] = epsilon_static_matrix
@@ -139,8 +819,101 @@ def get_epsilon_staticM_prettyform(pretty_formulas, dbjson_path):
     
     return get_epsilon_staticM_mpid(mp_ids, dbjson_path)
 
+def get_tensor_array(mp_ids, path_to_my_db_json, tensor_path='dielectric.epsilon_static', shape=(3, 3),
+                     chunk_size=1000, backend="remote", snapshot_file=None):
+    '''Returns a tensor (e.g. the epsilon static matrix) for each of the mp-ids, all in one numpy array, so that
+    quantities for all the materials can be worked out at once (see isotropic_average and tensor_eigenvalues) instead
+    of looping over a dict. The docs are found with one $in query per chunk of ids, only returning the tensor.
 
-def query_materials_by_id(mp_ids, path_to_my_db_json, additional_properties = []):
+    Parameters:
+        mp_ids (str list): The mp-ids of the materials. Ex. ['mp-594', 'mp-91']
+        path_to_my_db_json (str): the path to your db.sjon file, eg. '/home/calebh27/atomate/config/db.json'
+        tensor_path (str): where the tensor is in the materials doc, as a dot-path, or the name of a property in the
+                           metadata section. Ex. 'dielectric.epsilon_static', 'epsilon_ionic', 'elasticity.elastic_tensor'
+        shape (tuple): the shape of each tensor. Ex. (3, 3), or (6, 6) for elastic tensors
+        chunk_size (int): The number of mp-ids sent to the database in each query
+        backend (str): 'remote' to query the database, or 'local' to use the local snapshot (see materials_snapshot.py)
+        snapshot_file (str): the snapshot file used by the local backend (defaults to materials_snapshot.SNAPSHOT_FILE)
+    Returns:
+        tensors (np.ndarray): a float array of shape (len(mp_ids),) + shape, in the same order as mp_ids (all NaN where
+                              the tensor is missing)
+        ids (np.ndarray): the mp-id of each tensor
+        missing (np.ndarray): True where the material or its tensor was not found (or had the wrong shape)
+
+    '''
+
+    shape = tuple(shape)
+    check_backend(backend, [tensor_path], snapshot_file)
+
+    if backend == "local":
+        materials, missing_ids, duplicate_ids = snapshot_materials_by_ids(mp_ids, snapshot_file)
+    else:
+        materials_collection = get_materials_collection(path_to_my_db_json)
+        materials, missing_ids, duplicate_ids = find_materials_by_ids(materials_collection, mp_ids,
+                                                                      projection=build_projection([tensor_path]),
+                                                                      chunk_size=chunk_size)
+    print_lookup_report(missing_ids, duplicate_ids)
+
+    tensors = np.full((len(mp_ids),) + shape, np.nan)
+    paths = compile_property_paths([tensor_path])[0]
+
+    positions = []
+    values = []
+    for position, material in enumerate(materials):
+        for keys in paths:
+            value = get_path(material or {}, keys)
+            if value is not NOT_FOUND and value is not None:
+                positions.append(position)
+                values.append(value)
+                break
+
+    try:
+        # every tensor is converted in one go
+        tensors[positions] = np.array(values, dtype=float).reshape((len(values),) + shape)
+    except (TypeError, ValueError):
+        # some are the wrong shape (or not numbers), so they are done one at a time and the bad ones left as NaN
+        for position, value in zip(positions, values):
+            try:
+                tensor = np.array(value, dtype=float)
+            except (TypeError, ValueError):
+                continue
+            if tensor.shape == shape:
+                tensors[position] = tensor
+
+    missing = np.isnan(tensors).reshape(len(mp_ids), int(np.prod(shape))).all(axis=1)
+    if missing.any():
+        print("{} of the {} materials do not have {}".format(int(missing.sum()), len(mp_ids), tensor_path))
+
+    return tensors, np.array(mp_ids, dtype=object), missing
+
+def isotropic_average(tensors):
+    '''Returns the trace/3 of each tensor in an (n, 3, 3) array (NaN for missing tensors)'''
+
+    return np.trace(tensors, axis1=-2, axis2=-1) / tensors.shape[-1]
+
+def tensor_eigenvalues(tensors):
+    '''Returns the eigenvalues (smallest first) of each tensor in an (n, m, m) array, as an (n, m) array. The tensors
+    are symmetrized first, and missing tensors get NaN eigenvalues.'''
+
+    symmetric = (tensors + np.swapaxes(tensors, -1, -2)) / 2
+    eigenvalues = np.full(tensors.shape[:-1], np.nan)
+
+    found = ~np.isnan(symmetric).reshape(len(symmetric), tensors.shape[-1] ** 2).any(axis=1)
+    if found.any():
+        eigenvalues[found] = np.linalg.eigvalsh(symmetric[found])
+
+    return eigenvalues
+
+def tensor_anisotropy(tensors):
+    '''Returns (largest eigenvalue - smallest eigenvalue) / isotropic average for each tensor (0 for isotropic ones)'''
+
+    eigenvalues = tensor_eigenvalues(tensors)
+
+    return (eigenvalues[:, -1] - eigenvalues[:, 0]) / eigenvalues.mean(axis=1)
+
+
+def query_materials_by_id(mp_ids, path_to_my_db_json, additional_properties = [], chunk_size=1000, backend="remote",
+                          snapshot_file=None):
     '''Given a list of mp-ids, returns basic info from the database on all of them. It can also return values from
     the metadata section. 
 
@@ -150,15 +923,15 @@ def query_materials_by_id(mp_ids, path_to_my_db_json, additional_properties = []
         additional_properties (str list): Any additional properties that you wish to query. These must be the
                                           names that are used in the metadata section of the mongodb. Use 
                                           print_available_properties() to see options. Ex. ['epsilon_ionic']
+        chunk_size (int): The number of mp-ids sent to the database in each query
+        backend (str): 'remote' to query the database, or 'local' to use the local snapshot (see materials_snapshot.py)
+        snapshot_file (str): the snapshot file used by the local backend (defaults to materials_snapshot.SNAPSHOT_FILE)
     Returns:
-        df: a pandas DataFrame containing some basic info (formula, id, spacegroup, and keywords) on the materials
+        df: a pandas DataFrame containing some basic info (formula, id, spacegroup, and keywords) on the materials,
+            with one row for each of the given mp-ids (in the same order)
     
     '''
 
-    # set up the connection to the collection
-    atomate_db = VaspCalcDb.from_db_file(path_to_my_db_json)
-    materials_collection = atomate_db.db['materials']
-    
     # define the basic properties to query
     properties_to_query = ["formula_pretty", "mpids","sg_symbol","keywords"]
     property_names = ["Pretty Formula", "mp-id", "Space Group", "Keywords"]
@@ -167,28 +940,23 @@ def query_materials_by_id(mp_ids, path_to_my_db_json, additional_properties = []
     properties_to_query.extend(additional_properties)
     property_names.extend(additional_properties)
     
-    data = []
+    check_backend(backend, properties_to_query, snapshot_file)
 
-    for mp_id in mp_ids:
-        material = materials_collection.find_one({'mpids': mp_id})
-        current_material_properties = []
-    
-        for material_property in properties_to_query:
-            try: # search for the property on the first level
-                current_material_properties.append(material[material_property])
-            except: # search in the metadata block
-                    try:
-                        current_material_properties.append(material["_tasksbuilder"]["prop_metadata"]["energies"][material_property])
-                    except: # property not found
-                        current_material_properties.append("N/A")
-                        
-        # add match data to a data set
-        data.append(current_material_properties)
-    
-    # convert data to a dataframe
-    df = pd.DataFrame(data, columns=property_names)
+    # find all the material documents with one query per chunk of ids
+    if backend == "local":
+        materials, missing_ids, duplicate_ids = snapshot_materials_by_ids(mp_ids, snapshot_file)
+    else:
+        # set up the connection to the collection
+        materials_collection = get_materials_collection(path_to_my_db_json)
+        materials, missing_ids, duplicate_ids = find_materials_by_ids(materials_collection, mp_ids,
+                                                                      projection=build_projection(properties_to_query),
+                                                                      chunk_size=chunk_size)
+    print_lookup_report(missing_ids, duplicate_ids)
 
-    return df
+    # missing ids get a row of N/A (or NaN)
+    materials = [material if material is not None else {} for material in materials]
+
+    return materials_to_dataframe(materials, properties_to_query, property_names)
 
 def print_available_properties(path_to_my_db_json, mp_id='mp-594'):
     '''Prints out the properties that can be queried from the mongodb. It defaults to using NiS mp-594 as a 
@@ -203,8 +971,7 @@ def print_available_properties(path_to_my_db_json, mp_id='mp-594'):
     '''
     
     # set up the connection to the collection
-    atomate_db = VaspCalcDb.from_db_file(path_to_my_db_json)
-    materials_collection = atomate_db.db['materials']
+    materials_collection = get_materials_collection(path_to_my_db_json)
     
     material = materials_collection.find_one({'mpids': mp_id})
     
@@ -227,8 +994,7 @@ def print_all_material_info(path_to_my_db_json, mp_id):
     
     from pprint import pprint
     
-    atomate_db = VaspCalcDb.from_db_file(path_to_my_db_json)
-    materials_collection = atomate_db.db['materials']
+    materials_collection = get_materials_collection(path_to_my_db_json)
     
     material = materials_collection.find_one({'mpids': mp_id})
     pprint(material)
@@ -5,8 +5,23 @@ output database.
 Then run the program from the terminal.
 
 The original file can be found on Github at hackingmaterials/atomate/atomate/vasp/builders/examples/run_builders.py
+
+Each run only does the work that is needed: after a builder runs, the newest document it read (its high-water mark) in
+each of its input collections is saved in builder_state.json. The next time, a builder whose inputs have not changed
+since then (and whose dependencies did not run) is skipped, and TasksMaterialsBuilder is only given the tasks updated since its last run. Use --full to run
+every builder on everything, or --reset to start the builders from scratch.
+
+The builders are run in separate processes (--processes at a time), each one as soon as the builders it depends on
+(see build_graph) have finished, so builders that don't depend on each other run at the same time. If a builder fails,
+the builders that depend on it are not run, but the others still are.
 """
+import argparse
 import os
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from bson import json_util
 
 from atomate.vasp.builders.bandgap_estimation import BandgapEstimationBuilder
 from atomate.vasp.builders.boltztrap_materials import BoltztrapMaterialsBuilder
@@ -17,28 +32,240 @@ from atomate.vasp.builders.materials_ehull import MaterialsEhullBuilder
 from atomate.vasp.builders.tags import TagsBuilder
 from atomate.vasp.builders.tasks_materials import TasksMaterialsBuilder
 
+from db_connection import get_atomate_db
+from doc_paths import get_field
+
 __author__ = 'Anubhav Jain <ajain@lbl.gov>'
 
 module_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)))
 
+STATE_FILE = os.path.join(module_dir, "builder_state.json")
+
+# the collections the builders read, and the field that tells when a document was added or last changed
+TASKS = ("tasks", "last_updated")
+MATERIALS = ("materials", "_tasksbuilder.updated_at")
+BOLTZTRAP = ("boltztrap", "_id")
+
+# each builder, the collections it reads, and the builders that have to finish before it starts (the ones that write
+# the fields its find() query looks for)
+build_graph = {"FixTasksBuilder": (FixTasksBuilder, [TASKS], []),
+               "TasksMaterialsBuilder": (TasksMaterialsBuilder, [TASKS], ["FixTasksBuilder"]),
+               "TagsBuilder": (TagsBuilder, [TASKS, MATERIALS], ["TasksMaterialsBuilder"]),
+               "MaterialsDescriptorBuilder": (MaterialsDescriptorBuilder, [MATERIALS], ["TasksMaterialsBuilder"]),
+               "DielectricBuilder": (DielectricBuilder, [MATERIALS], ["TasksMaterialsBuilder"]),
+               # reads dielectric.epsilon_static_avg, which DielectricBuilder works out
+               "BandgapEstimationBuilder": (BandgapEstimationBuilder, [MATERIALS], ["DielectricBuilder"]),
+               "BoltztrapMaterialsBuilder": (BoltztrapMaterialsBuilder, [MATERIALS, BOLTZTRAP], ["TasksMaterialsBuilder"]),
+               "MaterialsEhullBuilder": (MaterialsEhullBuilder, [MATERIALS], ["TasksMaterialsBuilder"])}
+
+PROCESSES = 4
+
+# datetimes are read back the same way MongoDB returns them, so saved and current marks can be compared
+_JSON_OPTIONS = json_util.JSONOptions(tz_aware=False)
+
+
+def load_state(state_file=STATE_FILE):
+    '''Reads the high-water marks saved by the last run (an empty dict if there are none)'''
+
+    if not os.path.exists(state_file):
+        return {}
+    with open(state_file) as f:
+        return json_util.loads(f.read(), json_options=_JSON_OPTIONS)
+
+def save_state(state, state_file=STATE_FILE):
+    '''Saves the high-water marks, writing a temporary file first so a crash can't leave half a file behind'''
+
+    with open(state_file + ".tmp", "w") as f:
+        f.write(json_util.dumps(state, indent=2, json_options=_JSON_OPTIONS))
+    os.replace(state_file + ".tmp", state_file)
+
+def collection_mark(db, collection_name, field):
+    '''Gets the high-water mark of a collection: the newest value of its timestamp field, the newest _id (which changes
+    when documents are added) and the number of documents (which changes when they are removed)
+
+    Parameters:
+        db (object): the pymongo database
+        collection_name (str): the collection. Ex: 'tasks'
+        field (str): the field that is set when a document is added or changed. Ex: 'last_updated'
+    Returns:
+        mark (dict): the newest field value, newest _id and document count
+
+    '''
+
+    collection = db[collection_name]
+    # the sorts below only read one index entry each, instead of the whole collection (_id always has an index)
+    if field != "_id":
+        collection.create_index(field)
+
+    newest = collection.find_one({field: {"$exists": True}}, {field: 1}, sort=[(field, -1)])
+    last_added = collection.find_one({}, {"_id": 1}, sort=[("_id", -1)])
+
+    return {"updated": get_field(newest, field) if newest else None,
+            "last_id": last_added["_id"] if last_added else None,
+            "count": collection.estimated_document_count()}
+
+def input_marks(db, inputs):
+    '''Gets the high-water mark of each collection a builder reads'''
+
+    return {collection_name: collection_mark(db, collection_name, field) for collection_name, field in inputs}
+
+def make_builder(cls, dbfile, previous_marks, api_key=None):
+    '''Creates the builder from db.json. TasksMaterialsBuilder is only given the tasks updated since its last run
+    (it already skips tasks it has seen, but otherwise has to go through all of them to find out which ones those are)'''
+
+    if cls is TasksMaterialsBuilder and previous_marks and previous_marks["tasks"]["updated"] is not None:
+        return cls.from_file(dbfile, query={"last_updated": {"$gte": previous_marks["tasks"]["updated"]}})
+    if cls is MaterialsEhullBuilder:
+        return cls.from_file(dbfile, mapi_key=api_key)
+    return cls.from_file(dbfile)
+
+def new_input_count(db, inputs, previous_marks):
+    '''Counts the input documents added or changed since the builder's last run (all of them if it has not run)'''
+
+    count = 0
+    for collection_name, field in inputs:
+        previous = (previous_marks or {}).get(collection_name, {}).get("updated")
+        query = {} if previous is None else {field: {"$gt": previous}}
+        count += db[collection_name].count_documents(query)
+    return count
+
+def check_build_graph(graph):
+    '''Returns the builders in an order where each one comes after the builders it depends on. Raises a ValueError
+    if one depends on a builder that isn't in the graph, or if the dependencies go in a circle'''
+
+    order = []
+    visiting = set()
+
+    def visit(name, path):
+        if name in order:
+            return
+        if name not in graph:
+            raise ValueError("{} depends on {}, which is not in the build graph".format(path[-1], name))
+        if name in visiting:
+            raise ValueError("The builders depend on each other in a circle: " + " -> ".join(path + [name]))
+        visiting.add(name)
+        for dependency in graph[name][2]:
+            visit(dependency, path + [name])
+        order.append(name)
+
+    for name in graph:
+        visit(name, [])
+    return order
+
+def _run_builder(cls, dbfile, previous_marks, api_key, reset):
+    '''Runs one builder (in a worker process), and returns how many seconds it took'''
+
+    start = time.time()
+    b = make_builder(cls, dbfile, previous_marks, api_key)
+    if reset:
+        b.reset()
+    b.run()
+    return time.time() - start
+
+def print_build_stats(stats):
+    '''Prints what happened to each builder, how long it took and how many new input documents it had'''
+
+    print("{:<28}{:<10}{:>10}{:>12}".format("Builder", "Status", "Seconds", "New inputs"))
+    for name, (status, seconds, new_inputs) in stats.items():
+        print("{:<28}{:<10}{:>10}{:>12}".format(name, status, "" if seconds is None else "{:.1f}".format(seconds),
+                                                "" if new_inputs is None else new_inputs))
+
+def run_incremental(dbfile, state_file=STATE_FILE, full=False, reset=False, api_key=None, processes=PROCESSES,
+                    graph=None):
+    '''Runs each builder in the build graph whose inputs have changed since its last run, as soon as the builders it
+    depends on are done, up to processes at a time. The new high-water marks are saved as each builder finishes.
+
+    Parameters:
+        dbfile (str): the path to your db.json
+        state_file (str): the file the high-water marks are saved in
+        full (bool): run every builder on everything, whether or not its inputs changed
+        reset (bool): reset every builder before running it (start from scratch)
+        api_key (str): your Materials Project API key, for MaterialsEhullBuilder
+        processes (int): the most builders to run at the same time
+        graph (dict): the builders to run, in the same form as build_graph (defaults to build_graph)
+    Returns:
+        stats (dict): for each builder, its status ('done', 'skipped', 'failed' or 'blocked'), the seconds it took, and
+                      the number of input documents that were new or changed
+
+    '''
+
+    graph = build_graph if graph is None else graph
+    order = check_build_graph(graph)
+
+    db = get_atomate_db(dbfile).db
+    state = {} if full or reset else load_state(state_file)
+
+    stats = {}
+    running = {}
+    # the marks and new input count of each running builder, saved once it finishes
+    started = {}
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        while len(stats) < len(order):
+            # start every builder whose dependencies are done, or block it if one of them failed
+            for name in order:
+                if name in stats or name in running.values():
+                    continue
+                cls, inputs, dependencies = graph[name]
+                dependency_status = [stats[dependency][0] for dependency in dependencies if dependency in stats]
+                if "failed" in dependency_status or "blocked" in dependency_status:
+                    stats[name] = ("blocked", None, None)
+                    print("{}: not run, because a builder it depends on failed".format(name))
+                    continue
+                if len(dependency_status) < len(dependencies):
+                    continue
+
+                # taken before the builder runs, so anything added while it runs is picked up next time
+                marks = input_marks(db, inputs)
+                previous_marks = state.get(name, {}).get("inputs")
+                # the builders it depends on can write its inputs without moving the marks (e.g. DielectricBuilder
+                # sets dielectric.epsilon_static_avg, but not _tasksbuilder.updated_at), so if one of them ran, so does it
+                dependency_ran = any(stats[dependency][0] == "done" for dependency in dependencies)
+                if previous_marks == marks and not dependency_ran:
+                    stats[name] = ("skipped", None, 0)
+                    print("{}: no new inputs, skipping".format(name))
+                    continue
+
+                new_inputs = new_input_count(db, inputs, previous_marks)
+                future = pool.submit(_run_builder, cls, dbfile, previous_marks, api_key, reset)
+                running[future] = name
+                started[name] = (marks, new_inputs)
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                marks, new_inputs = started.pop(name)
+                try:
+                    seconds = future.result()
+                except Exception:
+                    stats[name] = ("failed", None, new_inputs)
+                    print("{} failed:".format(name))
+                    traceback.print_exc()
+                    continue
+
+                stats[name] = ("done", seconds, new_inputs)
+                state[name] = {"inputs": marks, "seconds": round(seconds, 1)}
+                save_state(state, state_file)
+                print("{}: finished in {:.1f} seconds ({} new input documents)".format(name, seconds, new_inputs))
+
+    print_build_stats({name: stats[name] for name in order})
+    return stats
+
 if __name__ == "__main__":
 
+    parser = argparse.ArgumentParser(description="Runs the atomate builders on the new tasks and materials")
+    parser.add_argument("--full", action="store_true", help="run every builder, even if its inputs have not changed")
+    parser.add_argument("--reset", action="store_true", help="start every builder from scratch")
+    parser.add_argument("--processes", type=int, default=PROCESSES, help="the most builders to run at the same time")
+    args = parser.parse_args()
+
     dbfile = os.path.join(module_dir, "db.json")  # make sure to modify w/your db details
 
-    build_sequence = [FixTasksBuilder, TasksMaterialsBuilder, TagsBuilder,
-                      MaterialsDescriptorBuilder, BandgapEstimationBuilder, DielectricBuilder,
-                      BoltztrapMaterialsBuilder]
-    for cls in build_sequence:
-        b = cls.from_file(dbfile)
-        # b.reset()  # uncomment if you want to start a builder from scratch!
-        b.run()
-    
     # A bit of code I added to get the api_key from the file we already put it in...
     with open("api_key.txt",'r') as filename:
-        API_KEY = filename.readlines()[0]
-        
-    # Uncomment below to run MP Ehull builder
+        API_KEY = filename.readlines()[0].strip()
 
-    mapi_key = API_KEY  # Replace with your Materials API key!
-    ehull_builder = MaterialsEhullBuilder.from_file(dbfile, mapi_key=mapi_key)
-    ehull_builder.run()
\ No newline at end of file
+    run_incremental(dbfile, full=args.full, reset=args.reset, api_key=API_KEY, processes=args.processes)
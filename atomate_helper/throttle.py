@@ -0,0 +1,92 @@
+'''Paces how quickly workflows are added to the launchpad, instead of a fixed cap on the number of workflows.
+
+Before each batch is added, the number of fireworks waiting to run or running (READY, RESERVED and RUNNING) is counted
+in the launchpad. If adding the batch would put more than target_backlog fireworks in the queue, or if MongoDB is slow
+to answer the count (a sign it is overloaded), the submission waits and checks again. This keeps enough work in the
+launchpad for the cluster to stay busy, without flooding the database.'''
+
+import time
+
+# the fireworks that count as the backlog
+BACKLOG_STATES = ("READY", "RESERVED", "RUNNING")
+
+TARGET_BACKLOG = 500
+# seconds the count query may take before MongoDB is considered overloaded
+MAX_LATENCY = 1.0
+POLL_INTERVAL = 60
+# seconds to wait for room before giving up (if MongoDB stays slow, or the backlog never goes down)
+MAX_WAIT = 6 * 3600
+
+
+def launchpad_backlog(launchpad):
+    '''Counts the fireworks in each of the BACKLOG_STATES, with a single aggregation, and times how long MongoDB took.
+
+    Parameters:
+        launchpad (object): the launchpad
+    Returns:
+        counts (dict): the number of fireworks in each state. Ex: {'READY': 120, 'RESERVED': 4, 'RUNNING': 24}
+        latency (float): the number of seconds the query took
+
+    '''
+
+    start = time.perf_counter()
+    results = launchpad.fireworks.aggregate([{"$match": {"state": {"$in": list(BACKLOG_STATES)}}},
+                                             {"$group": {"_id": "$state", "count": {"$sum": 1}}}])
+    counts = {state: 0 for state in BACKLOG_STATES}
+    for result in results:
+        counts[result["_id"]] = result["count"]
+    latency = time.perf_counter() - start
+
+    return counts, latency
+
+def submission_budget(launchpad, target_backlog=TARGET_BACKLOG, max_latency=MAX_LATENCY):
+    '''Returns how many more fireworks can be added right now (0 if MongoDB is answering too slowly)
+
+    Parameters:
+        launchpad (object): the launchpad
+        target_backlog (int): the number of READY/RESERVED/RUNNING fireworks to aim for
+        max_latency (float): the number of seconds the count may take before MongoDB is considered overloaded
+    Returns:
+        budget (int): the number of fireworks that can be added
+
+    '''
+
+    counts, latency = launchpad_backlog(launchpad)
+    if latency > max_latency:
+        return 0
+
+    return max(0, target_backlog - sum(counts.values()))
+
+def wait_for_capacity(launchpad, fireworks_needed, target_backlog=TARGET_BACKLOG, max_latency=MAX_LATENCY,
+                      poll_interval=POLL_INTERVAL, max_wait=MAX_WAIT):
+    '''Waits until there is room in the launchpad for fireworks_needed more fireworks. A batch bigger than the whole
+    target_backlog goes in once the backlog is empty. Raises a TimeoutError if there is still no room after max_wait
+    seconds.
+
+    Parameters:
+        launchpad (object): the launchpad
+        fireworks_needed (int): the number of fireworks about to be added that will be READY right away (the root
+                                fireworks of the workflows, the others wait for them to finish)
+        target_backlog (int): the number of READY/RESERVED/RUNNING fireworks to aim for
+        max_latency (float): the number of seconds the count may take before MongoDB is considered overloaded
+        poll_interval (float): the number of seconds to wait between checks
+        max_wait (float): the most seconds to wait (None waits for as long as it takes)
+    Returns:
+        waited (float): the number of seconds spent waiting
+
+    '''
+
+    needed = min(fireworks_needed, target_backlog)
+    start = time.time()
+    reported = False
+
+    while submission_budget(launchpad, target_backlog, max_latency) < needed:
+        if max_wait is not None and time.time() - start >= max_wait:
+            raise TimeoutError("There was no room in the launchpad for {} more fireworks after {:.0f} seconds (the "
+                               "backlog did not go down, or MongoDB stayed busy)".format(fireworks_needed, max_wait))
+        if not reported:
+            print("The launchpad is full (or MongoDB is busy), waiting to add {} more fireworks...".format(fireworks_needed))
+            reported = True
+        time.sleep(poll_interval if max_wait is None else min(poll_interval, max(0, max_wait - (time.time() - start))))
+
+    return time.time() - start
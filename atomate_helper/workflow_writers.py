@@ -1,7 +1,17 @@
-from helper_core import get_material_ids, get_pretty_formula
-from pymatgen.ext.matproj import MPRester
+from helper_core import get_material_ids, get_pretty_formula, iter_structures
+from db_connection import get_launchpad
+from campaign_journal import load_campaign, record_fetched, record_built, record_submitted
+from duplicate_index import find_duplicates, workflow_metadata
+from throttle import wait_for_capacity
 import numpy as np
 import pandas as pd
+import time
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, repeat
+import json
+from fireworks import Workflow
 
 # import prebuilt workflows
 from atomate.vasp.workflows.presets.core import wf_dielectric_constant
@@ -12,9 +22,9 @@ from atomate.vasp.workflows.presets.core import wf_bandstructure
 # import incar modifier
 from atomate.vasp.powerups import add_modify_incar
 
-# get API Key
-with open("api_key.txt",'r') as filename:
-    API_KEY = filename.readlines()[0]
+# the columns of the dataframes returned when workflows are added. The low and high fw_ids, and the list of all the
+# fw_ids of the workflow, are what workflows_from_fw_ids uses to find which workflow a firework belongs to
+SUBMISSION_COLUMNS = ["Task ID Range", "Formula", "mp-id", "Workflow Type", "Low fw_id", "High fw_id", "fw_ids"]
 
 def print_launchpad_error():
     '''Function to print error, to save space in code'''
@@ -38,8 +48,6 @@ def added_workflow_list_converter(task_ids_map, workflow_name, mp_id, formula=""
         
     '''
     
-    added_info = []
-    
     #get the firetask ids
     task_ids = list(task_ids_map.values())
     task_range = str(task_ids[0]) + "-" + str(task_ids[-1])
@@ -47,9 +55,38 @@ def added_workflow_list_converter(task_ids_map, workflow_name, mp_id, formula=""
     if formula == "":
         formula = get_pretty_formula(mp_id)
 
-    added_info.extend([task_range, formula, mp_id, workflow_name])
-            
-    return added_info
+    return submission_row(task_range, formula, mp_id, workflow_name, task_ids)
+
+def submission_row(task_range, formula, mp_id, workflow_name, fw_ids):
+    '''Puts together the info on one added workflow, in the order of SUBMISSION_COLUMNS'''
+
+    fw_ids = sorted(int(fw_id) for fw_id in fw_ids)
+
+    return [task_range, formula, mp_id, workflow_name, fw_ids[0], fw_ids[-1], fw_ids]
+
+def prepare_workflow(structure, orig_wf, incar_update=None):
+    '''Checks if the given structure has 30 or fewer sites, and if it does, changes the INCAR settings. Any other
+    INCAR changes that were asked for are made at the same time.
+
+    Parameters:
+        structure - a pymatgen type structure
+        orig_wf - The original workflow that was created for the structure
+        incar_update - (dict) other INCAR settings to change in every calculation. Ex: {'EDIFF': 1e-6}
+    Returns:
+        wf - the workflow, ready to be added to the launchpad
+
+    '''
+
+    changes = {}
+    if len(structure) <= 30:
+        # small structures should have lreal set to false: See  https://www.vasp.at/wiki/index.php/LREAL 
+        changes['LREAL'] = "False"
+    changes.update(incar_update or {})
+
+    if not changes:
+        return orig_wf
+
+    return add_modify_incar(orig_wf, modify_incar_params={'incar_update': changes})
 
 def check_size_add_wf(structure, orig_wf, launchpad):
     ''''Checks if the given structure has fewer than 30 elements, if it does, changes the INCAR settings
@@ -57,242 +94,646 @@ def check_size_add_wf(structure, orig_wf, launchpad):
     Parameters:
         structure - a pymatgen type structure
         orig_wf - The original workflow that was created for the structure
-        launchpad - the launchpad
+        launchpad - the launchpad, or the path to your my_launchpad.yaml file (the connection is then reused between calls)
     Returns:
         task_ids_map - the map containing the task ids
         
     '''
 
-    if len(structure) > 30:
+    if isinstance(launchpad, str):
+        launchpad = get_launchpad(launchpad)
+
+    try:
+        task_ids_map = launchpad.add_wf(prepare_workflow(structure, orig_wf))
+    except:
+        print_launchpad_error()
+        return
+
+    return task_ids_map
+
+def insert_workflow_batch(workflows, launchpad, task_ids_maps=None):
+    '''Adds a list of workflows to the launchpad together, using launchpad.bulk_add_wfs (a couple of insert_many
+    calls and one fw_id counter update for the whole list) when the installed FireWorks has it. Otherwise they are
+    added one at a time with add_wf.
+
+    Parameters:
+        workflows (list): the Workflow objects to add
+        launchpad (object): the launchpad
+        task_ids_maps (list): a list that the map of each workflow is added to as soon as the workflow is in the
+                              launchpad, so that if add_wf fails partway, the caller still knows which ones got in
+    Returns:
+        task_ids_maps (list): for each workflow, the map from its old to its new fw_ids (like launchpad.add_wf returns)
+
+    '''
+
+    if task_ids_maps is None:
+        task_ids_maps = []
+
+    if not hasattr(launchpad, "bulk_add_wfs"):
+        for wf in workflows:
+            task_ids_maps.append(launchpad.add_wf(wf))
+        return task_ids_maps
+
+    # bulk_add_wfs gives the fireworks their new ids in place, instead of returning them
+    old_ids = [[fw.fw_id for fw in wf.fws] for wf in workflows]
+    launchpad.bulk_add_wfs(workflows)
+
+    task_ids_maps.extend(dict(zip(old, [fw.fw_id for fw in wf.fws])) for old, wf in zip(old_ids, workflows))
+    return task_ids_maps
+
+def add_workflow_batch(batch, launchpad, batch_number, added_run_info, failed_batches):
+    '''Adds one batch of workflows to the launchpad, and records the result: the info on each workflow added is
+    appended to added_run_info, and if the batch failed, its number, the mp-ids that were not added and the error are
+    appended to failed_batches.
+
+    Parameters:
+        batch (list): (workflow, mp_id, formula, workflow_name) for each workflow to add
+        launchpad (object): the launchpad
+        batch_number (int): the number used for this batch when reporting errors
+        added_run_info (list): the list of added workflow info (see submission_row) to add to
+        failed_batches (list): the list of failed batches to add to
+    Returns:
+        task_ids_maps (list): the map of old to new fw_ids for each workflow that was added (None if none were)
+
+    '''
+
+    task_ids_maps = []
+    try:
+        insert_workflow_batch([wf for wf, _, _, _ in batch], launchpad, task_ids_maps)
+    except Exception as error:
+        # the workflows added one at a time before the error are in the launchpad, so only the rest failed
+        mp_ids = [mp_id for _, mp_id, _, _ in batch[len(task_ids_maps):]]
+        failed_batches.append({"batch": batch_number, "mp-ids": mp_ids, "error": repr(error)})
+        print("Error: {} of the {} workflows in batch {} were not added to the database: {!r}".format(
+            len(mp_ids), len(batch), batch_number, error))
+
+    for task_ids_map, (_, mp_id, formula, workflow_name) in zip(task_ids_maps, batch):
+        added_run_info.append(added_workflow_list_converter(task_ids_map, workflow_name, mp_id, formula))
+
+    return task_ids_maps or None
+
+def bulk_add_workflows(new_workflows, launchpad, batch_size=100, pause=0):
+    '''Adds already built workflows to the launchpad in batches. If a batch fails, the error is reported and the
+    remaining batches are still added, so nothing that was already added is lost.
+
+    Parameters:
+        new_workflows (list): (workflow, mp_id, formula, workflow_name) for each workflow to add. The workflows should
+                              already have gone through prepare_workflow.
+        launchpad (object): A launchpad (link to MongoDB) created by the user, or the path to your my_launchpad.yaml file
+        batch_size (int): the number of workflows added to the database at a time
+        pause (float): seconds to wait between batches, to go easy on MongoDB
+
+    Returns:
+        df: A pandas dataframe containing the firetask ids, formula, mp-id and workflow type for each workflow added
+        failed_batches (list): a dict for each batch that was not added, with the batch number, its mp-ids and the error
+
+    '''
+
+    if isinstance(launchpad, str):
+        launchpad = get_launchpad(launchpad)
+
+    added_run_info = []
+    failed_batches = []
+
+    for batch_number, start in enumerate(range(0, len(new_workflows), batch_size)):
+        if batch_number > 0 and pause:
+            time.sleep(pause)
+
+        add_workflow_batch(new_workflows[start:start + batch_size], launchpad, batch_number, added_run_info, failed_batches)
+
+    if failed_batches:
+        print_launchpad_error()
+        print("mp-ids that were not added:", [mp_id for failed in failed_batches for mp_id in failed["mp-ids"]])
+
+    df = pd.DataFrame(added_run_info, columns=SUBMISSION_COLUMNS)
+
+    return df, failed_batches
+
+def gibbs_config():
+    '''The configuration used for the gibbs workflows'''
+
+    # Set up the deformation matricies, where each deformation is a 3x3 list of strains.
+    # There will be 7 structures between +/- 10% volume. Note that the 1/3 power is so
+    # that we scale each direction by (x+1)^(1/3) and the total volume by (x+1).
+    deformations = [(np.eye(3)*((1+x)**(1.0/3.0))).tolist() for x in np.linspace(-0.1, 0.1, 7)]
+
+    # Create the configurations dictionary, defining the temperature range,
+    # Poisson ratio (from experiments or the Materials Project), turning on consideration
+    # of anharmonic contributions, and finally the deformation matrix describing points
+    # on the energy vs. volume curve.
+    c = {"T_MIN": 10, "T_STEP": 10, "T_MAX": 2000,
+         "POISSON": 0.20, "ANHARMONIC_CONTRIBUTION": True,
+         "DEFORMATIONS": deformations, "QHA_TYPE":"phonopy"}
+    
+    # I added the "qha_type" above - the default appears to be "debye_model" (see line 466 at https://github.com/hackingmaterials/atomate/blob/main/atomate/vasp/workflows/presets/core.py)
+
+    return c
+
+def build_dielectric_wf(structure):
+    return wf_dielectric_constant(structure)
+
+def build_gibbs_wf(structure):
+    return wf_gibbs_free_energy(structure, gibbs_config())
+
+def build_bandstructure_wf(structure):
+    return wf_bandstructure(structure)
+
+def build_elastic_wf(structure):
+    return wf_elastic_constant(structure)
+
+# the function that creates each type of workflow from a structure. Add your own with register_workflow_builder.
+WORKFLOW_BUILDERS = {'dielectric': build_dielectric_wf,
+                     'gibbs': build_gibbs_wf,
+                     'bandstructure': build_bandstructure_wf,
+                     'elastic': build_elastic_wf}
+
+def register_workflow_builder(workflow_name, workflow_builder):
+    '''Adds a new type of workflow that can be used with add_workflows_mpid (or replaces an existing one)
+
+    Parameters:
+        workflow_name (str): the name of the workflow type, which is also put in the "Workflow Type" column. Ex: 'optics'
+        workflow_builder (function): takes a pymatgen structure and returns a Workflow. To build with max_workers > 1
+                                     it has to be defined at the top level of a .py file (so it can be sent to the
+                                     worker processes), not in a notebook cell.
+    Returns:
+        None
+
+    '''
+
+    WORKFLOW_BUILDERS[workflow_name] = workflow_builder
+
+def workflow_process_pool(max_workers):
+    '''Starts the process pool the workflows are built in, with its worker processes already running. Where they are
+    forked from this process (the default on Linux), all of them are forked by the first task, so it is sent here,
+    before add_workflows_mpid starts its other threads: forking while another thread is downloading structures or
+    writing the journal can leave a worker stuck on a lock that thread was holding.'''
+
+    pool = ProcessPoolExecutor(max_workers=max_workers)
+    pool.submit(int).result()
+    return pool
+
+def build_prepared_workflow(workflow_builder, structure, incar_update=None):
+    '''Creates the workflow for a structure and runs it through prepare_workflow. Done in the worker processes of
+    build_workflows_parallel, so it returns the workflow as a dict (which is quicker to send back than the object).'''
+
+    return prepare_workflow(structure, workflow_builder(structure), incar_update).to_dict()
+
+def build_workflows_parallel(structures, workflow_name, max_workers=1, chunksize=1, pool=None, incar_update=None):
+    '''Creates (and prepares, see prepare_workflow) a workflow for each structure. Building gibbs and elastic workflows
+    takes a lot of CPU time, so with max_workers > 1 the structures are split between that many processes.
+
+    Parameters:
+        structures (list): the pymatgen structures
+        workflow_name (str): the type of workflow, one of the keys of WORKFLOW_BUILDERS. Ex: 'dielectric', 'elastic'
+        max_workers (int): the number of processes to use. 1 builds everything in this process, and None uses one
+                           process per core (os.cpu_count())
+        chunksize (int): the number of structures sent to a process at a time
+        pool (ProcessPoolExecutor): an already running pool to use instead of starting a new one (max_workers is then ignored)
+        incar_update (dict): other INCAR settings to change in every calculation (see prepare_workflow)
+    Returns:
+        workflows (list): the workflows, in the same order as the structures
+
+    '''
+
+    workflow_builder = WORKFLOW_BUILDERS[workflow_name]
+
+    if pool is None and (max_workers == 1 or len(structures) <= 1):
+        return [prepare_workflow(structure, workflow_builder(structure), incar_update) for structure in structures]
+
+    if pool is None:
+        with workflow_process_pool(max_workers) as pool:
+            return build_workflows_parallel(structures, workflow_name, chunksize=chunksize, pool=pool,
+                                            incar_update=incar_update)
+
+    # map hands the results back in the same order as the structures
+    wf_dicts = pool.map(build_prepared_workflow, repeat(workflow_builder), structures, repeat(incar_update),
+                        chunksize=chunksize)
+    return [Workflow.from_dict(wf_dict) for wf_dict in wf_dicts]
+
+# marks the end of the items put on a pipeline queue
+_DONE = object()
+
+def _put(stage_queue, item, stop):
+    '''Puts an item on a bounded queue, waiting for room unless the pipeline has been stopped'''
+
+    while not stop.is_set():
         try:
-            task_ids_map = launchpad.add_wf(orig_wf)
-        except:
-            print_launchpad_error()
+            stage_queue.put(item, timeout=0.5)
             return
-    else:
-        # small structures should have lreal set to false: See  https://www.vasp.at/wiki/index.php/LREAL 
-        modified_wf = add_modify_incar(orig_wf, modify_incar_params={'incar_update': {'LREAL': "False"}})
+        except queue.Full:
+            pass
+
+def _run_stage(work, output_queue, stop):
+    '''Runs one stage of the pipeline in its own thread. Whatever happens, the next stage is told that this one is
+    finished (an error is passed along to be raised in the submitting thread).'''
+
+    try:
+        work()
+    except BaseException as error:
+        _put(output_queue, error, stop)
+    finally:
+        _put(output_queue, _DONE, stop)
+
+def _queue_items(stage_queue, stop):
+    '''Takes the items off a pipeline queue until the stage before it is finished (or the pipeline is stopped)'''
+
+    while not stop.is_set():
         try:
-            task_ids_map = launchpad.add_wf(modified_wf)
-        except:
-            print_launchpad_error()
+            item = stage_queue.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        if item is _DONE:
             return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
 
-    return task_ids_map
+def add_workflows_mpid(mp_ids, workflow_name, launchpad, batch_size=100, pause=0, max_workers=1,
+                       fetch_chunk_size=100, queue_size=4, campaign=None, journal_file=None, incar_update=None,
+                       duplicate_policy='skip', target_backlog=None):
+    '''Adds a workflow of the given type for each mp-id, and then returns a list with pertinant information. This is
+    what all of the add_*_mpid functions use. The work is done in three stages that run at the same time, connected by
+    queues that hold at most queue_size chunks: getting the structures from the MP (fetch_chunk_size ids at a time),
+    building the workflows (see build_workflows_parallel), and adding them to the launchpad (batch_size at a time).
+
+    If a campaign name is given, the progress of each mp-id is saved in the campaign journal (see campaign_journal.py).
+    Running the same campaign again then skips the mp-ids that were already submitted, and reuses the structures that
+    were already downloaded, so a campaign that stopped partway can just be run again.
+
+    Before anything is downloaded, the mp-ids are checked against the workflows already in the launchpad (see
+    duplicate_index.py), and duplicate_policy decides what happens to ones that already have the same type of workflow
+    with the same INCAR changes.
+
+    If target_backlog is given, each batch waits until the launchpad has room for it (see throttle.py), so that the
+    queue stays full without overloading MongoDB.
+
+    Parameters:
+        mp_ids (str lst): list of mp-ids. Ex: ['mp-594', 'mp-1547']
+        workflow_name (str): the type of workflow, one of the keys of WORKFLOW_BUILDERS (see register_workflow_builder).
+                             Ex: 'dielectric', 'elastic'
+        launchpad (object): A launchpad (link to MongoDB) created by the user, or the path to your my_launchpad.yaml file
+        batch_size (int): The number of workflows added to the database at a time
+        pause (float): Seconds to wait between batches, to go easy on MongoDB
+        max_workers (int): The number of processes used to build the workflows (see build_workflows_parallel)
+        fetch_chunk_size (int): The number of mp-ids whose structures are asked for in each MP query
+        queue_size (int): The number of chunks that can wait between two stages
+        campaign (str): The name of the campaign, to record its progress in the journal. Ex: 'dielectric 09/2021'
+        journal_file (str): The journal file to use (defaults to campaign_journal.JOURNAL_FILE)
+        incar_update (dict): Other INCAR settings to change in every calculation. Ex: {'EDIFF': 1e-6}
+        duplicate_policy (str): What to do with mp-ids that are already in the launchpad: 'skip' leaves them out,
+                                'force' submits them anyway, and 'report' prints them and stops without submitting anything
+        target_backlog (int): The number of READY/RESERVED/RUNNING fireworks to keep in the launchpad. Batches wait
+                              until there is room for them (None adds them right away). If there is no room after
+                              throttle.MAX_WAIT seconds, no more are added (use a campaign to be able to resume)
+
+    Returns:
+        df: A pandas dataframe containing the firetask ids and material_id for each workflow added (including the
+            ones added by earlier runs of the same campaign). If downloading or building the structures fails partway,
+            or there is no room in the launchpad for too long, the error is printed and the workflows added up to then
+            are still returned
+
+    '''
+
+    if workflow_name not in WORKFLOW_BUILDERS:
+        raise ValueError("Unknown workflow type '{}', the options are: {}".format(workflow_name, list(WORKFLOW_BUILDERS)))
+    if duplicate_policy not in ('skip', 'force', 'report'):
+        raise ValueError("duplicate_policy should be 'skip', 'force' or 'report', not '{}'".format(duplicate_policy))
+    if isinstance(launchpad, str):
+        launchpad = get_launchpad(launchpad)
+
+    mp_ids = list(dict.fromkeys(mp_ids))
+    previous_run_info = []
+    saved_structures = {}
+    saved_formulas = {}
+
+    if campaign is not None:
+        submitted, saved_structures, saved_formulas = load_campaign(campaign, workflow_name, journal_file)
+
+        previous_run_info = [submission_row(submitted[mp_id][1], submitted[mp_id][0], mp_id, workflow_name, submitted[mp_id][2])
+                             for mp_id in mp_ids if mp_id in submitted]
+        if previous_run_info:
+            print("Skipping {} mp-ids that were already submitted in campaign '{}'".format(len(previous_run_info), campaign))
+
+        mp_ids = [mp_id for mp_id in mp_ids if mp_id not in submitted]
+
+    if duplicate_policy != 'force':
+        duplicate_ids = find_duplicates(launchpad, mp_ids, workflow_name, incar_update)
+
+        if duplicate_ids and duplicate_policy == 'report':
+            print("The following ids already have a {} workflow in the launchpad, nothing was submitted: ".format(workflow_name),
+                  duplicate_ids)
+            return pd.DataFrame(previous_run_info, columns=SUBMISSION_COLUMNS)
+        if duplicate_ids:
+            print("Skipping {} ids that already have a {} workflow in the launchpad: ".format(len(duplicate_ids), workflow_name),
+                  duplicate_ids)
+            duplicate_ids = set(duplicate_ids)
+            mp_ids = [mp_id for mp_id in mp_ids if mp_id not in duplicate_ids]
+
+    fetched_queue = queue.Queue(maxsize=queue_size)
+    built_queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    pool = workflow_process_pool(max_workers) if max_workers != 1 and mp_ids else None
+
+    # the workflows are added in the same order as mp_ids
+    position = {mp_id: index for index, mp_id in enumerate(mp_ids)}
+
+    def fetch():
+        # structures saved in the journal are not downloaded again
+        saved_ids = [mp_id for mp_id in mp_ids if mp_id in saved_structures]
+        for start in range(0, len(saved_ids), fetch_chunk_size):
+            _put(fetched_queue, (saved_ids[start:start + fetch_chunk_size], saved_structures, saved_formulas), stop)
+
+        to_fetch = [mp_id for mp_id in mp_ids if mp_id not in saved_structures]
+        if not to_fetch:
+            return
+
+        #import the structures from the materials database, one chunk at a time
+        for structures, formulas, _ in iter_structures(to_fetch, fetch_chunk_size):
+            if stop.is_set():
+                return
+            if campaign is not None:
+                record_fetched(campaign, workflow_name, structures, formulas, journal_file)
+            found_ids = sorted(structures, key=lambda mp_id: position.get(mp_id, len(position)))
+            _put(fetched_queue, (found_ids, structures, formulas), stop)
+
+    def build():
+        # create the workflows (checking the size of each structure)
+        for found_ids, structures, formulas in _queue_items(fetched_queue, stop):
+            workflows = build_workflows_parallel([structures[mp_id] for mp_id in found_ids], workflow_name, pool=pool,
+                                                 incar_update=incar_update)
+            # saved with the workflow, so later submissions can tell that it is already in the launchpad
+            for wf, mp_id in zip(workflows, found_ids):
+                wf.metadata.update(workflow_metadata(mp_id, workflow_name, incar_update))
+            if campaign is not None:
+                record_built(campaign, workflow_name, found_ids, journal_file)
+            _put(built_queue, [(wf, mp_id, formulas[mp_id], workflow_name) for wf, mp_id in zip(workflows, found_ids)], stop)
+
+    added_run_info = []
+    failed_batches = []
+    batch_number = 0
+    timed_out = False
+
+    def submit(batch):
+        nonlocal batch_number, timed_out
+
+        if batch_number > 0 and pause:
+            time.sleep(pause)
+        if target_backlog is not None:
+            # only the root fireworks are READY right away, the rest wait for them
+            try:
+                wait_for_capacity(launchpad, sum(len(wf.root_fw_ids) for wf, _, _, _ in batch), target_backlog)
+            except TimeoutError as error:
+                print("Error: {}. No more workflows will be added".format(error))
+                timed_out = True
+                return
+
+        first_row = len(added_run_info)
+        task_ids_maps = add_workflow_batch(batch, launchpad, batch_number, added_run_info, failed_batches)
+        batch_number += 1
+
+        if task_ids_maps is not None and campaign is not None:
+            record_submitted(campaign, workflow_name,
+                             [(mp_id, formula, task_range, fw_ids) for task_range, formula, mp_id, _, _, _, fw_ids
+                              in added_run_info[first_row:]], journal_file)
 
-def add_dielectric_mpid(mp_ids, launchpad):
+    stages = [threading.Thread(target=_run_stage, args=(fetch, fetched_queue, stop), daemon=True),
+              threading.Thread(target=_run_stage, args=(build, built_queue, stop), daemon=True)]
+    for stage in stages:
+        stage.start()
+
+    waiting = []
+    stage_error = None
+
+    try:
+        # add the workflows to the database, batch_size at a time, as they are built
+        try:
+            for built in _queue_items(built_queue, stop):
+                waiting.extend(built)
+                while len(waiting) >= batch_size and not timed_out:
+                    submit(waiting[:batch_size])
+                    waiting = waiting[batch_size:]
+                if timed_out:
+                    break
+        except Exception as error:
+            # e.g. an MP API error partway through: the workflows already added (and built) are kept and returned
+            stage_error = error
+            print("Error: stopped fetching and building the workflows: {!r}".format(error))
+
+        if waiting and not timed_out:
+            submit(waiting)
+    finally:
+        stop.set()
+        for stage in stages:
+            stage.join()
+        if pool is not None:
+            pool.shutdown()
+
+    if failed_batches:
+        print_launchpad_error()
+        print("mp-ids that were not added:", [mp_id for failed in failed_batches for mp_id in failed["mp-ids"]])
+    if stage_error is not None or timed_out:
+        added_ids = {row[2] for row in added_run_info}
+        print("mp-ids that were not added because of the error:", [mp_id for mp_id in mp_ids if mp_id not in added_ids])
+
+    df = pd.DataFrame(previous_run_info + added_run_info, columns=SUBMISSION_COLUMNS)
+    print(df)
+
+    return df
+
+def add_dielectric_mpid(mp_ids, launchpad, batch_size=100, pause=0, max_workers=1, campaign=None, target_backlog=None):
     '''Adds dielectric workflows for each mp-id in a list of inputs, and then returns a list with pertinant information
     
     Parameters:
         mp_ids (str lst): list of mp-ids. Ex: ['mp-594', 'mp-1547']
         launchpad (object): A launchpad (link to MongoDB) created by the user
+        batch_size (int): The number of workflows added to the database at a time
+        pause (float): Seconds to wait between batches, to go easy on MongoDB
+        max_workers (int): The number of processes used to build the workflows (see build_workflows_parallel)
+        campaign (str): A name for this campaign, to be able to resume it if it stops partway (see add_workflows_mpid)
+        target_backlog (int): If given, workflows are only added as fast as the queue allows (see add_workflows_mpid)
         
     Returns:
         df: A pandas dataframe containing the firetask ids and material_id for each workflow added
         
     '''
-    
-    added_run_info = []
-    
-    for mp_id in mp_ids:
-        #import the structure from the materials database
-        with MPRester(API_KEY) as mpr:
-            struct = mpr.get_structure_by_material_id(mp_id)
-
-        # create the Workflow
-        wf = wf_dielectric_constant(struct)
-        # checks the size, then addds the workflow
-        task_ids_map = check_size_add_wf(struct, wf, launchpad)
-        # quits if it was not added successfully. 
-        if task_ids_map is None:
-            return
 
-        #create the info list for this workflow
-        added_info = added_workflow_list_converter(task_ids_map, 'dielectric', mp_id)
-        added_run_info.append(added_info)
-
-    df = pd.DataFrame(added_run_info, columns=["Task ID Range", "Formula", "mp-id", "Workflow Type"])
-    print(df)
-
-    return df
+    return add_workflows_mpid(mp_ids, 'dielectric', launchpad, batch_size=batch_size, pause=pause, max_workers=max_workers,
+                              campaign=campaign, target_backlog=target_backlog)
     
     
-def add_dielectric_prettyform(pretty_formulas, launchpad, workflow_cap=100):
+def add_dielectric_prettyform(pretty_formulas, launchpad, workflow_cap=100, batch_size=100, pause=0, max_workers=1,
+                              campaign=None, target_backlog=None):
     """ Adds dielectric workflows for each material in a list of inputs, and then returns a list with pertinant information
 
     Parameters:
         pretty_formulas (list): a list of compounds with their pretty formulas. Ex: ['NiS', 'MgO']
         launchpad (object): A launchpad (link to MongoDB) created by the user
         workflow_cap (int): Too many connections can cause mongo to crash, so a cap has been added to help users avoid that
+        batch_size (int): The number of workflows added to the database at a time
+        pause (float): Seconds to wait between batches, to go easy on MongoDB
+        max_workers (int): The number of processes used to build the workflows (see build_workflows_parallel)
+        campaign (str): A name for this campaign, to be able to resume it if it stops partway (see add_workflows_mpid)
+        target_backlog (int): If given, instead of stopping at workflow_cap, all the workflows are added, but only as fast
+                              as the queue allows (see add_workflows_mpid)
 
     Returns:
         df: A pandas dataframe containing the firetask ids, formula, and material_id for each workflow added
 
     """
 
-    total_wflows_added = 0
-    added_run_info = []
+    # when resuming a campaign, the workflows that were already added don't count towards the cap
+    already_submitted = {}
+    if campaign is not None:
+        already_submitted, _, _ = load_campaign(campaign, 'dielectric')
 
     #gets all the material ids for the given pretty formulas
+    mp_ids = []
+    new_count = 0
     for formula in pretty_formulas:
-        mp_ids = get_material_ids(formula)
+        formula_ids = get_material_ids(formula)
+        formula_new_count = len([mp_id for mp_id in formula_ids if mp_id not in already_submitted])
 
-        #first, test to ensure we haven't added too many at once
-        if (total_wflows_added + len(mp_ids)) > workflow_cap:
+        #first, test to ensure we haven't added too many at once (not needed when submissions are paced)
+        if target_backlog is None and (new_count + formula_new_count) > workflow_cap:
             print('''Max number of workflows ({}) exceeded. To avoid crashing MongoDB, please wait for these to finish before adding any more. Resume with formula: {}'''.format(workflow_cap, formula))
-            df = pd.DataFrame(added_run_info, columns=["Task ID Range", "Formula", "mp-id", "Workflow Type"])
-            print(df)
-            return df
-
-        for mp_id in mp_ids:
-            #import the structure from the materials database
-            with MPRester(API_KEY) as mpr:
-                struct = mpr.get_structure_by_material_id(mp_id)
-
-            # create and add the Workflow
-            wf = wf_dielectric_constant(struct)
-            # checks the size, then addds the workflow
-            task_ids_map = check_size_add_wf(struct, wf, launchpad)
-            # quits if it was not added successfully. 
-            if task_ids_map is None:
-                return
+            break
 
-            total_wflows_added += 1
-            
-            #create the info list for this workflow
-            added_info = added_workflow_list_converter(task_ids_map, 'dielectric', mp_id, formula)
-            added_run_info.append(added_info)
+        mp_ids.extend(formula_ids)
+        new_count += formula_new_count
 
-    df = pd.DataFrame(added_run_info, columns=["Task ID Range", "Formula", "mp-id", "Workflow Type"])
-    print(df)
-
-    return df
+    return add_workflows_mpid(mp_ids, 'dielectric', launchpad, batch_size=batch_size, pause=pause, max_workers=max_workers,
+                              campaign=campaign, target_backlog=target_backlog)
 
 
-def add_gibbs_mpid(mp_ids, launchpad):
+def add_gibbs_mpid(mp_ids, launchpad, batch_size=100, pause=0, max_workers=1, campaign=None, target_backlog=None):
     '''Adds gibbs workflows for each mp-id in a list of inputs, and then returns a list with pertinant information
     
     Parameters:
         mp_ids (str lst): list of mp-ids. Ex: ['mp-594', 'mp-1547']
         launchpad (object): A launchpad (link to MongoDB) created by the user
+        batch_size (int): The number of workflows added to the database at a time
+        pause (float): Seconds to wait between batches, to go easy on MongoDB
+        max_workers (int): The number of processes used to build the workflows (see build_workflows_parallel)
+        campaign (str): A name for this campaign, to be able to resume it if it stops partway (see add_workflows_mpid)
+        target_backlog (int): If given, workflows are only added as fast as the queue allows (see add_workflows_mpid)
         
     Returns:
         df: A pandas dataframe containing the firetask ids and material_id for each workflow added
         
     '''
-    
-    added_run_info = []
-    
-    for mp_id in mp_ids:
-        #import the structure from the materials database
-        with MPRester(API_KEY) as mpr:
-            struct = mpr.get_structure_by_material_id(mp_id)
-
-        # Set up the deformation matricies, where each deformation is a 3x3 list of strains.
-        # There will be 7 structures between +/- 10% volume. Note that the 1/3 power is so
-        # that we scale each direction by (x+1)^(1/3) and the total volume by (x+1).
-        deformations = [(np.eye(3)*((1+x)**(1.0/3.0))).tolist() for x in np.linspace(-0.1, 0.1, 7)]
-
-        # Create the configurations dictionary, defining the temperature range,
-        # Poisson ratio (from experiments or the Materials Project), turning on consideration
-        # of anharmonic contributions, and finally the deformation matrix describing points
-        # on the energy vs. volume curve.
-        c = {"T_MIN": 10, "T_STEP": 10, "T_MAX": 2000,
-             "POISSON": 0.20, "ANHARMONIC_CONTRIBUTION": True,
-             "DEFORMATIONS": deformations, "QHA_TYPE":"phonopy"}
-        
-        # I added the "qha_type" above - the default appears to be "debye_model" (see line 466 at https://github.com/hackingmaterials/atomate/blob/main/atomate/vasp/workflows/presets/core.py)
-        
-        #create workflow and add to mongodb
-        wf = wf_gibbs_free_energy(struct, c)
-        # checks the size, then addds the workflow
-        task_ids_map = check_size_add_wf(struct, wf, launchpad)
-        # quits if it was not added successfully. 
-        if task_ids_map is None:
-            return
 
+    return add_workflows_mpid(mp_ids, 'gibbs', launchpad, batch_size=batch_size, pause=pause, max_workers=max_workers,
+                              campaign=campaign, target_backlog=target_backlog)
 
-        #create the info list for this workflow
-        added_info = added_workflow_list_converter(task_ids_map, 'gibbs', mp_id)
-        added_run_info.append(added_info)
-        
-    df = pd.DataFrame(added_run_info, columns=["Task ID Range", "Formula", "mp-id", "Workflow Type"])
-    print(df)
-
-    return df
-
-def add_bandstucture_mpid(mp_ids, launchpad):
+def add_bandstucture_mpid(mp_ids, launchpad, batch_size=100, pause=0, max_workers=1, campaign=None, target_backlog=None):
     '''Adds bandstructure workflows for each mp-id in a list of inputs, and then returns a list with pertinant information
     
     Parameters:
         mp_ids (str lst): list of mp-ids. Ex: ['mp-594', 'mp-1547']
         launchpad (object): A launchpad (link to MongoDB) created by the user
+        batch_size (int): The number of workflows added to the database at a time
+        pause (float): Seconds to wait between batches, to go easy on MongoDB
+        max_workers (int): The number of processes used to build the workflows (see build_workflows_parallel)
+        campaign (str): A name for this campaign, to be able to resume it if it stops partway (see add_workflows_mpid)
+        target_backlog (int): If given, workflows are only added as fast as the queue allows (see add_workflows_mpid)
         
     Returns:
         df: A pandas dataframe containing the firetask ids and material_id for each workflow added
         
     '''
-    
-    added_run_info = []
-    
-    for mp_id in mp_ids:
-        #import the structure from the materials database
-        with MPRester(API_KEY) as mpr:
-            struct = mpr.get_structure_by_material_id(mp_id)
-
-        # create and add the Workflow
-        wf = wf_bandstructure(struct)
-        # checks the size, then addds the workflow
-        task_ids_map = check_size_add_wf(struct, wf, launchpad)
-        # quits if it was not added successfully. 
-        if task_ids_map is None:
-            return
-
-        #create the info list for this workflow
-        added_info = added_workflow_list_converter(task_ids_map, 'bandstructure', mp_id)
-        added_run_info.append(added_info)
-        
-    df = pd.DataFrame(added_run_info, columns=["Task ID Range", "Formula", "mp-id", "Workflow Type"])
-    print(df)
 
-    return df
+    return add_workflows_mpid(mp_ids, 'bandstructure', launchpad, batch_size=batch_size, pause=pause, max_workers=max_workers,
+                              campaign=campaign, target_backlog=target_backlog)
 
-def add_elastic_mpid(mp_ids, launchpad):
+def add_elastic_mpid(mp_ids, launchpad, batch_size=100, pause=0, max_workers=1, campaign=None, target_backlog=None):
     '''Adds elastic workflows for each mp-id in a list of inputs, and then returns a list with pertinant information
     
     Parameters:
         mp_ids (str lst): list of mp-ids. Ex: ['mp-594', 'mp-1547']
         launchpad (object): A launchpad (link to MongoDB) created by the user
+        batch_size (int): The number of workflows added to the database at a time
+        pause (float): Seconds to wait between batches, to go easy on MongoDB
+        max_workers (int): The number of processes used to build the workflows (see build_workflows_parallel)
+        campaign (str): A name for this campaign, to be able to resume it if it stops partway (see add_workflows_mpid)
+        target_backlog (int): If given, workflows are only added as fast as the queue allows (see add_workflows_mpid)
         
     Returns:
         df: A pandas dataframe containing the firetask ids and material_id for each workflow added
         
     '''
-    
-    added_run_info = []
-    
-    for mp_id in mp_ids:
-        #import the structure from the materials database
-        with MPRester(API_KEY) as mpr:
-            struct = mpr.get_structure_by_material_id(mp_id)
-
-        # create and add the Workflow
-        wf = wf_elastic_constant(struct)
-        # checks the size, then addds the workflow
-        task_ids_map = check_size_add_wf(struct, wf, launchpad)
-        # quits if it was not added successfully. 
-        if task_ids_map is None:
-            return
 
-        #create the info list for this workflow
-        added_info = added_workflow_list_converter(task_ids_map, 'elastic', mp_id)
-        added_run_info.append(added_info)
-        
-    df = pd.DataFrame(added_run_info, columns=["Task ID Range", "Formula", "mp-id", "Workflow Type"])
-    print(df)
+    return add_workflows_mpid(mp_ids, 'elastic', launchpad, batch_size=batch_size, pause=pause, max_workers=max_workers,
+                              campaign=campaign, target_backlog=target_backlog)
 
-    return df
 
+def _fw_id_lists(df):
+    '''Returns the list of fw_ids of each row of a submission dataframe, or None if the dataframe doesn't have them
+    (dataframes saved before the fw_ids column was added). Lists that were saved to a csv file are read back.'''
+
+    if "fw_ids" not in df.columns or df["fw_ids"].isna().any():
+        return None
+
+    return [json.loads(fw_ids) if isinstance(fw_ids, str) else fw_ids for fw_ids in df["fw_ids"]]
+
+def _fw_id_bounds(df):
+    '''Returns the low and high fw_id of each row of a submission dataframe, as numpy arrays'''
+
+    if "Low fw_id" in df.columns and "High fw_id" in df.columns and not df[["Low fw_id", "High fw_id"]].isna().any(axis=None):
+        return df["Low fw_id"].to_numpy(dtype=np.int64), df["High fw_id"].to_numpy(dtype=np.int64)
+
+    # older dataframes only have the "low-high" string
+    bounds = df["Task ID Range"].str.split("-", expand=True).astype(np.int64).to_numpy()
+    return bounds.min(axis=1), bounds.max(axis=1)
+
+def workflows_from_fw_ids(df, fw_ids):
+    '''Finds the workflow (mp-id and type) that each of the given fireworks belongs to, using the dataframe returned
+    when the workflows were added. If the dataframe has the fw_ids column, each fw_id is matched exactly, so workflows
+    whose fw_ids are not one unbroken range are still found correctly; otherwise it is matched to the row whose low-high
+    range contains it. Either way the rows are sorted once and each fw_id is found with a binary search.
+
+    Parameters:
+        df (Pandas dataframe): Dataframe returned by add_dielectric_mpid (or the other add functions) when you first
+            added the workflows (several of them can be combined with pd.concat)
+        fw_ids (int list): The fw_ids to look up. Ex: the ones from "lpad get_wflows -s FIZZLED -d ids"
+    Returns:
+        matches: A pandas dataframe with the fw_id, mp-id and Workflow Type for each fw_id that was found, in the order
+            they were given (fw_ids that aren't in the dataframe are left out)
+
+    '''
+
+    fw_ids = np.asarray(fw_ids, dtype=np.int64).reshape(-1)
+    if len(df) == 0:
+        return pd.DataFrame({"fw_id": [], "mp-id": [], "Workflow Type": []})
+
+    fw_id_lists = _fw_id_lists(df)
+
+    if fw_id_lists is not None:
+        # every fw_id of every row, sorted, with the row it came from
+        lengths = np.array([len(row_ids) for row_ids in fw_id_lists], dtype=np.int64)
+        sorted_ids = np.fromiter(chain.from_iterable(fw_id_lists), dtype=np.int64, count=lengths.sum())
+        sorted_rows = np.repeat(np.arange(len(df)), lengths)
+        order = np.argsort(sorted_ids, kind="stable")
+        sorted_ids, sorted_rows = sorted_ids[order], sorted_rows[order]
+    else:
+        lows, highs = _fw_id_bounds(df)
+        order = np.argsort(lows, kind="stable")
+        sorted_ids, sorted_rows = lows[order], order
+
+    if fw_id_lists is not None:
+        positions = np.minimum(np.searchsorted(sorted_ids, fw_ids), len(sorted_ids) - 1)
+        matched_rows = sorted_rows[positions]
+        found = sorted_ids[positions] == fw_ids
+    else:
+        # the row with the largest low that is <= fw_id, if its high is >= fw_id
+        positions = np.searchsorted(sorted_ids, fw_ids, side="right") - 1
+        matched_rows = sorted_rows[np.maximum(positions, 0)]
+        found = (positions >= 0) & (fw_ids <= highs[matched_rows])
+
+    matched_rows = matched_rows[found]
+
+    return pd.DataFrame({"fw_id": fw_ids[found],
+                         "mp-id": df["mp-id"].to_numpy()[matched_rows],
+                         "Workflow Type": df["Workflow Type"].to_numpy()[matched_rows]})
 
 def mpids_from_fizzled_runs(df, fizzled_runs):
     '''This function was developed to deal with issues using the "lpad rerun_fws -s FIZZLED" command
@@ -300,7 +741,7 @@ def mpids_from_fizzled_runs(df, fizzled_runs):
     when you initially added the workflows, and the fw_ids returned from running "lpad get_wflows -s FIZZLED -d ids"
     on the supercomputer, it returns the list of mp-ids of the fizzled workflows. Can also be used to 
     get the mpids for runs of any state, by using the "lpad get_wflows -s ____ -d ids" command to get the respective
-    workflow ids. 
+    workflow ids. Use workflows_from_fw_ids to get the workflow types as well.
     
     Parameters:
         df (Pandas dataframe): Dataframe returned by add_dielectric_mpid function when you first added 
@@ -310,22 +751,5 @@ def mpids_from_fizzled_runs(df, fizzled_runs):
         ids_to_rerun (str list): The mp-ids of the structures that need to be rerun
     
     '''
-    
-    ids_to_rerun = []
-
-    for fw_id in fizzled_runs:
-    # search for a matching fw_id in the dataframe of launched runs
-        for range_interval in df["Task ID Range"].tolist():
-
-            # get the high and low for the range
-            range_list = range_interval.split("-")
-            low = int(range_list[0])
-            high = int(range_list[1])
-
-            # add the mp-id to the list if it was fizzled
-            if low <= fw_id <= high:
-                # get the mp-id
-                mp_id = df.loc[df['Task ID Range'] == range_interval]["mp-id"].tolist()[0]
-                ids_to_rerun.append(mp_id)
-            
-    return ids_to_rerun
+
+    return workflows_from_fw_ids(df, fizzled_runs)["mp-id"].tolist()
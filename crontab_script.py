@@ -1,39 +1,264 @@
 """
 Use this as the command you use to launch the qlaunch singleshot in reservation mode (see the crontab_setup.md file).
-It confirms that you have not exceeded the number of jobs that you would like to have running in the que, and then creates a file
+It confirms that you have not exceeded the number of jobs that you would like to have running in the que, and that
+there are READY fireworks in the launchpad to run (and MongoDB is not overloaded), and then creates a file
 folder for the documents needed for the run (If you don't use this, the vasp files from different runs will blend and create errors)
+
+It can also be left running instead of being started by cron (python crontab_script.py --daemon). It then checks the queue
+every POLL_INTERVAL seconds, launches as many jobs as there is room for each time, and removes the empty folders left
+in reserve_scratch by launches that did not get a job.
 NOTE:
 - You will need to change the path to your username
 - Put this script in your home directory
 """
 
 from datetime import datetime
+import argparse
 import os
 import subprocess
+import time
+
+from fireworks import LaunchPad
 
 MAX_IN_QUE = 24
+# if MongoDB takes longer than this (in seconds) to count the READY fireworks, it is too busy to launch more jobs
+MAX_DB_LATENCY = 2.0
+
+USERNAME = "calebh27"
+SCRATCH_DIR = "/fslhome/calebh27/atomate/reserve_scratch"
+# how often (in seconds) the daemon checks the queue
+POLL_INTERVAL = 300
+# empty folders in reserve_scratch older than this (in seconds) are removed by the daemon
+EMPTY_DIR_AGE = 3600
+
+# the limits for each partition jobs are launched in:
+#   max_jobs - the most jobs (in any state) to have in the partition
+#   max_pending - the most jobs to have waiting in the partition (optional)
+#   qadapter - the my_qadapter.yaml that submits to the partition (None for the default one)
+# the None entry counts all of your jobs together, whatever partition they are in. To spread the jobs over several
+# partitions, replace it with one entry per partition, e.g.
+#   {"m9": {"max_jobs": 24, "max_pending": 4, "qadapter": "/fslhome/calebh27/atomate/config/qadapter_m9.yaml"},
+#    "m8": {"max_jobs": 8, "max_pending": 2, "qadapter": "/fslhome/calebh27/atomate/config/qadapter_m8.yaml"}}
+PARTITION_BUDGETS = {None: {"max_jobs": MAX_IN_QUE, "qadapter": None}}
+
+def ready_fireworks(launchpad):
+    '''Returns the number of READY fireworks in the launchpad, and how many seconds MongoDB took to count them'''
+
+    start = time.perf_counter()
+    ready_count = launchpad.fireworks.count_documents({"state": "READY"})
+    return ready_count, time.perf_counter() - start
+
+def queue_jobs(username=USERNAME):
+    '''Returns the user's jobs in the queue, as a list of (job_id, state, partition), e.g. ('1234', 'PENDING', 'm9')'''
+
+    # -h leaves out the column headers, and the fields are separated by | so the output doesn't depend on column widths
+    queue_info = subprocess.run(['squeue', '-u', username, '-h', '-o', '%i|%T|%P'], capture_output=True, text=True,
+                                check=True).stdout
+
+    jobs = []
+    for line in queue_info.splitlines():
+        fields = line.strip().split('|')
+        if len(fields) == 3:
+            jobs.append(tuple(fields))
+    return jobs
+
+def job_table(jobs):
+    '''Counts the jobs by partition and state
+
+    Parameters:
+        jobs (list): (job_id, state, partition) for each job, from queue_jobs
+    Returns:
+        table (dict): the number of jobs in each state for each partition. Ex: {'m9': {'RUNNING': 20, 'PENDING': 3}}
+
+    '''
+
+    table = {}
+    for _, state, partition in jobs:
+        partition_counts = table.setdefault(partition, {})
+        partition_counts[state] = partition_counts.get(state, 0) + 1
+    return table
+
+def jobs_in_queue(username=USERNAME):
+    '''Returns the number of jobs the user has in the queue (in any state or partition)'''
+
+    return len(queue_jobs(username))
+
+def partition_headroom(table, budgets=PARTITION_BUDGETS):
+    '''Works out how many more jobs each partition in budgets can take
+
+    Parameters:
+        table (dict): the number of jobs in each state for each partition, from job_table
+        budgets (dict): the limits for each partition (see PARTITION_BUDGETS)
+    Returns:
+        headroom (dict): the number of jobs that can be added to each partition
+
+    '''
+
+    headroom = {}
+    for partition, budget in budgets.items():
+        if partition is None:
+            # the default budget counts all the jobs together
+            counts = {}
+            for partition_counts in table.values():
+                for state, count in partition_counts.items():
+                    counts[state] = counts.get(state, 0) + count
+        else:
+            counts = table.get(partition, {})
+
+        room = budget.get("max_jobs", MAX_IN_QUE) - sum(counts.values())
+        if "max_pending" in budget:
+            room = min(room, budget["max_pending"] - counts.get("PENDING", 0))
+        headroom[partition] = max(0, room)
+
+    return headroom
+
+def allocate_launch_slots(headroom, jobs_to_launch):
+    '''Splits the jobs to launch across the partitions, one at a time to whichever partition has the most room left,
+    so the jobs are spread over the partitions that are the least busy
+
+    Parameters:
+        headroom (dict): the number of jobs each partition can take, from partition_headroom
+        jobs_to_launch (int): the most jobs to launch in total
+    Returns:
+        slots (dict): the number of jobs to launch in each partition (partitions with none are left out)
+
+    '''
+
+    room_left = dict(headroom)
+    slots = {}
+    for _ in range(jobs_to_launch if room_left else 0):
+        # ties go to the partition listed first in the budgets
+        partition = max(room_left, key=room_left.get)
+        if room_left[partition] <= 0:
+            break
+        room_left[partition] -= 1
+        slots[partition] = slots.get(partition, 0) + 1
+
+    return slots
+
+def launch_budget(launchpad, username=USERNAME, budgets=PARTITION_BUDGETS, max_launches=None):
+    '''Works out how many jobs can be launched right now in each partition, printing the reason if it is none
+
+    Parameters:
+        launchpad (object): the launchpad
+        username (str): the user whose jobs are counted in the queue
+        budgets (dict): the limits for each partition (see PARTITION_BUDGETS)
+        max_launches (int): the most jobs to launch in total (None for no limit besides the budgets)
+    Returns:
+        slots (dict): the number of jobs to launch in each partition
+
+    '''
+
+    headroom = partition_headroom(job_table(queue_jobs(username)), budgets)
+    ready_count, db_latency = ready_fireworks(launchpad)
+
+    if not any(headroom.values()):
+        print("The queue is full in every partition")
+        return {}
+    if ready_count == 0:
+        print("There are no READY fireworks to launch")
+        return {}
+    if db_latency > MAX_DB_LATENCY:
+        print("MongoDB took {:.1f} seconds to answer, not launching until it is less busy".format(db_latency))
+        return {}
+
+    jobs_to_launch = ready_count if max_launches is None else min(ready_count, max_launches)
+    return allocate_launch_slots(headroom, jobs_to_launch)
+
+def launch_rocket(scratch_dir=SCRATCH_DIR, qadapter=None):
+    '''Creates a new folder in scratch_dir, named after the current datetime, and launches one job from it (with the
+    given my_qadapter.yaml, or the default one if qadapter is None)
+
+    Returns:
+        launch_info (str): what qlaunch printed
+
+    '''
+
+    # get datetime object, and format into string (with a number added if several are launched in the same second)
+    dt_string = datetime.now().strftime("%Y-%m-%d_%H:%M:%S")
+    run_dir = os.path.join(scratch_dir, dt_string)
+    count = 1
+    while os.path.exists(run_dir):
+        run_dir = os.path.join(scratch_dir, "{}_{}".format(dt_string, count))
+        count += 1
+
+    # create new directory, and launch the rocket from it
+    os.mkdir(run_dir)
+    command = ['qlaunch', '-r','singleshot']
+    if qadapter is not None:
+        command[1:1] = ['-q', qadapter]
+    return subprocess.run(command, capture_output=True, text=True, cwd=run_dir).stdout
+
+def remove_empty_dirs(scratch_dir=SCRATCH_DIR, min_age=EMPTY_DIR_AGE):
+    '''Removes the folders in scratch_dir that are still empty min_age seconds after they were made
+
+    Returns:
+        removed (int): the number of folders removed
+
+    '''
+
+    removed = 0
+    oldest_allowed = time.time() - min_age
+
+    for entry in os.scandir(scratch_dir):
+        if entry.is_dir(follow_symlinks=False) and entry.stat().st_mtime < oldest_allowed:
+            try:
+                os.rmdir(entry.path) # only works if the folder is empty
+                removed += 1
+            except OSError:
+                pass
+
+    return removed
+
+def run_once(launchpad, max_launches=1, scratch_dir=SCRATCH_DIR, budgets=PARTITION_BUDGETS):
+    '''Launches as many jobs as there is room for (up to max_launches), spread over the partitions in budgets
+
+    Returns:
+        launched (int): the number of jobs launched
+
+    '''
+
+    slots = launch_budget(launchpad, budgets=budgets, max_launches=max_launches)
+
+    for partition, count in slots.items():
+        for _ in range(count):
+            # runs command to launch a rocket
+            print(launch_rocket(scratch_dir, budgets[partition].get("qadapter")))
+
+    return sum(slots.values())
+
+def run_daemon(launchpad, interval=POLL_INTERVAL, scratch_dir=SCRATCH_DIR):
+    '''Keeps checking the queue every interval seconds, filling it up each time, until it is stopped (ctrl-c)'''
 
-# change the directory to be atomate/reserve_scratch
-os.chdir("/fslhome/calebh27/atomate/reserve_scratch")
+    print("Launching jobs every {} seconds, press ctrl-c to stop".format(interval))
 
-# get datetime object, and format into string
-now = datetime.now()
-dt_string = now.strftime("%Y-%m-%d_%H:%M:%S")
+    try:
+        while True:
+            tick_start = time.time()
+            try:
+                launched = run_once(launchpad, None, scratch_dir)
+                removed = remove_empty_dirs(scratch_dir)
+                print("{}: launched {} jobs, removed {} empty folders".format(datetime.now().strftime("%Y-%m-%d_%H:%M:%S"),
+                                                                              launched, removed))
+            except Exception as error:
+                # keep going, the squeue or MongoDB problem may be gone by the next check
+                print("Error while launching jobs:", repr(error))
 
-# create new directory, named after the current datetime
-os.mkdir(dt_string)
+            time.sleep(max(0, interval - (time.time() - tick_start)))
+    except KeyboardInterrupt:
+        print("Stopped")
 
-# move into the newly created directory
-os.chdir(os.getcwd() + "/"+ dt_string)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Launches qlaunch singleshot jobs in reservation mode")
+    parser.add_argument("--daemon", action="store_true", help="keep running, and check the queue every --interval seconds")
+    parser.add_argument("--interval", type=float, default=POLL_INTERVAL, help="seconds between checks in daemon mode")
+    parser.add_argument("--scratch-dir", default=SCRATCH_DIR, help="folder where the run folders are created")
+    args = parser.parse_args()
 
-# get the number of lines that are returned by the squeue command, which effectively
-# tells you how many things are currently running.
-queue_info = subprocess.run(['squeue', '-u', 'calebh27'], capture_output=True, text=True).stdout
-jobs_running = queue_info.count('\n') - 1 # first line is the column headers
+    # uses the launchpad from your my_launchpad.yaml, the same one qlaunch uses (the connection is kept between checks)
+    launchpad = LaunchPad.auto_load()
 
-if jobs_running <= MAX_IN_QUE:
-    # runs command to launch a rocket
-    launch_info = subprocess.run(['qlaunch', '-r','singleshot'], capture_output=True, text=True).stdout
-    print(launch_info)
-else:
-    print("There are already", MAX_IN_QUE, "jobs running")
+    if args.daemon:
+        run_daemon(launchpad, args.interval, args.scratch_dir)
+    else:
+        run_once(launchpad, 1, args.scratch_dir)
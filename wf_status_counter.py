@@ -1,23 +1,68 @@
-"""This is a short script I wrote for the supercomputer, which quickly gives you a count of how many workflows are in each of the various states. You will need to alter the path."""
-
-import os
-import subprocess
-
-# activate the atomate_env
-os.system("source /zhome/calebh27/atomate/atomate_env/bin/activate")
-
-print("Workflow Status Counts:")
-
-# Get the info on the status of all the various states
-completed_count = subprocess.run(['lpad', 'get_wflows', '-s', 'COMPLETED','-d','count'], capture_output=True, text=True).stdout
-print('Completed:', completed_count)
-running_count = subprocess.run(['lpad', 'get_wflows', '-s', 'RUNNING','-d','count'], capture_output=True, text=True).stdout
-print('Running:', running_count)
-ready_count = subprocess.run(['lpad', 'get_wflows', '-s', 'READY','-d','count'], capture_output=True, text=True).stdout
-print('Ready:', ready_count)
-fizzled_count = subprocess.run(['lpad', 'get_wflows', '-s', 'FIZZLED','-d','count'], capture_output=True, text=True).stdout
-print('Fizzled:', fizzled_count)
-paused_count = subprocess.run(['lpad', 'get_wflows', '-s', 'PAUSED','-d','count'], capture_output=True, text=True).stdout
-print('Paused:', paused_count)
-reserved_count = subprocess.run(['lpad', 'get_wflows', '-s', 'RESERVED','-d','count'], capture_output=True, text=True).stdout
-print('Reserved:', reserved_count)
+"""This is a short script I wrote for the supercomputer, which quickly gives you a count of how many workflows are in each of the various states.
+All the states are counted with a single query to the launchpad (the same one lpad uses, from your my_launchpad.yaml), instead of
+running "lpad get_wflows -s STATE -d count" once for each state. Run it from the terminal with the atomate_env activated:
+    python wf_status_counter.py
+    python wf_status_counter.py --group-by metadata.workflow_type
+    python wf_status_counter.py -l /path/to/my_launchpad.yaml
+"""
+
+import argparse
+
+from fireworks import LaunchPad
+
+# every state a workflow can be in, in the order they are printed
+WORKFLOW_STATES = ["COMPLETED", "RUNNING", "READY", "RESERVED", "WAITING", "FIZZLED", "PAUSED", "DEFUSED", "ARCHIVED"]
+
+def workflow_state_counts(launchpad, group_by=None):
+    '''Counts the workflows in each state with one aggregation over the workflows collection.
+
+    Parameters:
+        launchpad (object): the launchpad
+        group_by (str): a field of the workflow docs to split the counts by. Ex: 'metadata.workflow_type'
+    Returns:
+        counts (dict): the number of workflows in each state, e.g. {'COMPLETED': 120, 'RUNNING': 4, ...}. With group_by,
+                       a dict like that for each value of the field, e.g. {'dielectric': {...}, 'elastic': {...}}
+
+    '''
+
+    group_id = {"state": "$state"}
+    if group_by is not None:
+        group_id["group"] = "$" + group_by
+
+    results = launchpad.workflows.aggregate([{"$group": {"_id": group_id, "count": {"$sum": 1}}}])
+
+    counts = {}
+    for result in results:
+        group_counts = counts.setdefault(result["_id"].get("group"), {state: 0 for state in WORKFLOW_STATES})
+        group_counts[result["_id"]["state"]] = result["count"]
+
+    if group_by is None:
+        return counts.get(None, {state: 0 for state in WORKFLOW_STATES})
+    return counts
+
+def print_counts(counts):
+    '''Prints the count for each state, e.g. "Completed: 120"'''
+
+    for state, count in counts.items():
+        print(" {}: {}".format(state.capitalize(), count))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Counts the workflows in the launchpad in each state")
+    parser.add_argument("-l", "--launchpad_file", help="path to your my_launchpad.yaml (defaults to the one lpad uses)")
+    parser.add_argument("--group-by", help="a workflow field to split the counts by, e.g. metadata.workflow_type")
+    args = parser.parse_args()
+
+    if args.launchpad_file:
+        launchpad = LaunchPad.from_file(args.launchpad_file)
+    else:
+        launchpad = LaunchPad.auto_load()
+
+    print("Workflow Status Counts:")
+
+    counts = workflow_state_counts(launchpad, args.group_by)
+    if args.group_by is None:
+        print_counts(counts)
+    else:
+        for group, group_counts in counts.items():
+            print("{} = {}:".format(args.group_by, group))
+            print_counts(group_counts)